@@ -1,23 +1,83 @@
 import os
-from flask import Flask, render_template, request, redirect, url_for, jsonify
+import json
+import hashlib
+import sqlite3
+from flask import Flask, Response, render_template, request, redirect, url_for, jsonify, stream_with_context
 from flask_sqlalchemy import SQLAlchemy
-from datetime import datetime, timedelta
+from sqlalchemy import event as sa_event, inspect as sa_inspect, or_
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import Session, joinedload, selectinload
+from sqlalchemy.types import TypeDecorator
+from datetime import datetime, timedelta, timezone
 import random
+import time
+from collections import Counter, namedtuple
 
 app = Flask(__name__)
 # Use environment variable for DB path (Render persistence), fallback to local
 app.config['SQLALCHEMY_DATABASE_URI'] = os.environ.get('DATABASE_URL', 'sqlite:///cycles.db')
+
+# ---- DATABASE ENGINE ----
+# Under a threaded/multi-worker server every worker holds its own pool, so keep
+# each one small and recycle connections before the server side drops them.
+if app.config['SQLALCHEMY_DATABASE_URI'].startswith('sqlite'):
+    # SQLite pools per thread; writers wait on the lock instead of failing fast
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {
+        "connect_args": {"timeout": int(os.environ.get("SQLITE_BUSY_TIMEOUT", 30)), "check_same_thread": False},
+    }
+else:
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {
+        "pool_size": int(os.environ.get("DB_POOL_SIZE", 5)),
+        "max_overflow": int(os.environ.get("DB_MAX_OVERFLOW", 10)),
+        "pool_recycle": int(os.environ.get("DB_POOL_RECYCLE", 1800)),
+        "pool_pre_ping": True,
+    }
+
 db = SQLAlchemy(app)
 
+@sa_event.listens_for(Engine, "connect")
+def configure_sqlite(dbapi_conn, _record):
+    # WAL lets sync polls keep reading while a push is being written
+    if not isinstance(dbapi_conn, sqlite3.Connection): return
+    cur = dbapi_conn.cursor()
+    cur.execute("PRAGMA journal_mode=WAL")
+    cur.execute(f"PRAGMA busy_timeout={int(os.environ.get('SQLITE_BUSY_TIMEOUT', 30)) * 1000}")
+    cur.execute("PRAGMA synchronous=NORMAL")
+    cur.close()
+
 # ---- MODELS ----
 import uuid
 
+class WireDate(TypeDecorator):
+    # Native DATE column that also accepts the "YYYY-MM-DD" strings used on the
+    # wire and in payloads, so callers can hand either to the ORM or Core.
+    impl = db.Date
+    cache_ok = True
+
+    def process_bind_param(self, value, dialect):
+        if isinstance(value, str):
+            return datetime.strptime(value[:10], "%Y-%m-%d").date() if value else None
+        if isinstance(value, datetime):
+            return value.date()
+        return value
+
+def wire_date(value):
+    # date -> "YYYY-MM-DD" (the JSON format clients have always received)
+    return value.isoformat() if value else None
+
 class DeletedRecord(db.Model):
+    __table_args__ = (db.Index('ix_deleted_record_team_rev', 'team_id', 'sync_rev'),)
     id = db.Column(db.Integer, primary_key=True)
-    uid = db.Column(db.String(36), nullable=False)
-    timestamp = db.Column(db.DateTime, default=datetime.utcnow)
+    uid = db.Column(db.String(36), nullable=False, index=True)
+    team_id = db.Column(db.String(50)) # Owning team (NULL: global, e.g. disbanded teams, legacy rows)
+    timestamp = db.Column(db.DateTime, default=datetime.utcnow, index=True)
+    sync_rev = db.Column(db.Integer, default=0, index=True) # Change Cursor
 
 class Patient(db.Model):
+    __table_args__ = (
+        db.Index('ix_patient_team_updated', 'team_id', 'updated_at'),
+        db.Index('ix_patient_team_rev', 'team_id', 'sync_rev'),
+    )
     id = db.Column(db.Integer, primary_key=True)
     uid = db.Column(db.String(36), unique=True, default=lambda: str(uuid.uuid4())) # Unique Sync ID
     team_id = db.Column(db.String(50), default='DEFAULT') # <-- For Multi-Team Management
@@ -28,22 +88,25 @@ class Patient(db.Model):
     regime = db.Column(db.String(50), nullable=False)
     remark = db.Column(db.String(500))
     updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow) # Sync Timestamp
+    sync_rev = db.Column(db.Integer, default=0) # Change Cursor (also bumped by event edits)
+    content_hash = db.Column(db.String(40)) # Digest of fields + events (see CONTENT DIGEST)
     events = db.relationship("Event", backref="patient", lazy=True, cascade="all, delete-orphan")
 
 class Event(db.Model):
+    __table_args__ = (db.Index('ix_event_patient_original_start', 'patient_id', 'original_start'),)
     id = db.Column(db.Integer, primary_key=True)
     title = db.Column(db.String(50))
-    start = db.Column(db.String(20))
+    start = db.Column(WireDate, index=True)
     color = db.Column(db.String(20))
     patient_id = db.Column(db.Integer, db.ForeignKey("patient.id"))
-    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow) # Sync Timestamp
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow, index=True) # Sync Timestamp
 
     # New fields for per-milestone data
     missed_days = db.Column(db.Integer, default=0)
     remark = db.Column(db.String(200))
     outcome = db.Column(db.String(20))  # e.g., Failed, LTFU, Died, Cured, Completed
 
-    original_start = db.Column(db.String(20))  # store original planned date
+    original_start = db.Column(WireDate)  # store original planned date
 
 # ---- TEAM MODELS ----
 class Team(db.Model):
@@ -54,10 +117,15 @@ class Team(db.Model):
     is_public = db.Column(db.Boolean, default=False) # New: Public/Private toggle
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+    sync_rev = db.Column(db.Integer, default=0) # Change Cursor
 
 # ...
 
 class TeamMember(db.Model):
+    __table_args__ = (
+        db.Index('ix_team_member_device_status', 'device_id', 'status'),
+        db.Index('ix_team_member_team_status', 'team_slug', 'status'),
+    )
     id = db.Column(db.Integer, primary_key=True)
     team_slug = db.Column(db.String(50), nullable=False) # e.g. "ygn-team"
     user_name = db.Column(db.String(100), nullable=False) # e.g. "Dr. Smith" or Device Name
@@ -65,18 +133,224 @@ class TeamMember(db.Model):
     status = db.Column(db.String(20), default='PENDING') # PENDING, APPROVED
     role = db.Column(db.String(20), default='MEMBER') # ADMIN, MEMBER
     updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+    sync_rev = db.Column(db.Integer, default=0) # Change Cursor
+    synced_rev = db.Column(db.Integer, default=0) # Last cursor this device acknowledged for the team
+
+# ---- REGIME MODEL ----
+# Treatment schedules added at runtime (see REGIME SCHEDULES)
+class Regime(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    code = db.Column(db.String(50), unique=True, nullable=False) # Upper-cased Patient.regime
+    name = db.Column(db.String(100))
+    milestones = db.Column(db.Text, nullable=False) # JSON: [{"label": "Start", "offset": 0}, ...]
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+# ---- STAGING MODELS ----
+# Guest pushes awaiting host review (see Stage Incoming). Kept in the database so
+# they survive restarts and are shared by every worker.
+class StagedDevice(db.Model):
+    device_name = db.Column(db.String(100), primary_key=True)
+    ip = db.Column(db.String(45))
+    pushes = db.Column(db.Integer, default=0)
+    size_bytes = db.Column(db.Integer, default=0) # Payload size of the pending items
+    last_seen = db.Column(db.DateTime, default=datetime.utcnow, index=True)
+
+class StagedItem(db.Model):
+    __table_args__ = (db.Index('ix_staged_item_device_kind', 'device_name', 'kind'),)
+    id = db.Column(db.Integer, primary_key=True)
+    device_name = db.Column(db.String(100), nullable=False)
+    kind = db.Column(db.String(10), nullable=False) # record, deletion, team, member
+    uid = db.Column(db.String(36)) # Patient uid for records/deletions
+    payload = db.Column(db.Text) # JSON of the pushed item
+    created_at = db.Column(db.DateTime, default=datetime.utcnow, index=True)
+
+# ---- CHANGE CURSOR ----
+# Delta sync compares a server-side revision number instead of wall-clock time.
+# Every flush that touches synced rows takes the next value from this one-row
+# counter and stamps it on them. The UPDATE holds the row lock until commit, so
+# revisions become visible in increasing order and a client's cursor never skips
+# a concurrent write (which timestamps cannot guarantee).
+class SyncCounter(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    value = db.Column(db.Integer, nullable=False, default=0)
+    compacted_rev = db.Column(db.Integer, default=0) # Cursors below this may have missed a compacted tombstone
+    members_rev = db.Column(db.Integer, default=0) # Bumped whenever any team_member row changes
 
+SYNCED_MODELS = (Patient, Team, TeamMember, DeletedRecord)
+
+def next_sync_rev(session):
+    conn = session.connection()
+    bumped = conn.execute(
+        SyncCounter.__table__.update().where(SyncCounter.id == 1).values(value=SyncCounter.value + 1)
+    )
+    if bumped.rowcount == 0:
+        conn.execute(SyncCounter.__table__.insert().values(id=1, value=1))
+    return conn.execute(db.select(SyncCounter.value).where(SyncCounter.id == 1)).scalar()
+
+def read_sync_counter():
+    row = db.session.execute(
+        db.select(SyncCounter.value, SyncCounter.compacted_rev).where(SyncCounter.id == 1)
+    ).first()
+    return (row.value, row.compacted_rev or 0) if row else (0, 0)
+
+def current_sync_rev():
+    return read_sync_counter()[0]
+
+def bump_members_rev(session):
+    # Memberships changed: every worker's cached authorizations are now stale
+    conn = session.connection()
+    bumped = conn.execute(
+        SyncCounter.__table__.update().where(SyncCounter.id == 1)
+        .values(members_rev=db.func.coalesce(SyncCounter.members_rev, 0) + 1)
+    )
+    if bumped.rowcount == 0:
+        conn.execute(SyncCounter.__table__.insert().values(id=1, value=0, members_rev=1))
+
+def current_members_rev():
+    return db.session.execute(db.select(SyncCounter.members_rev).where(SyncCounter.id == 1)).scalar() or 0
+
+def bump_patient_revs(session, rev, patient_ids):
+    # Event changes surface in delta sync through their parent patient
+    if not patient_ids: return
+    session.connection().execute(
+        Patient.__table__.update().where(Patient.id.in_(patient_ids)).values(sync_rev=rev)
+    )
+    mark_content_changed(session, patient_ids)
+
+@sa_event.listens_for(Session, "before_flush")
+def stamp_sync_revs(session, flush_context, instances):
+    if any(isinstance(o, TeamMember) for o in list(session.new) + list(session.dirty) + list(session.deleted)):
+        bump_members_rev(session)
+    changed = [o for o in session.new if isinstance(o, SYNCED_MODELS)]
+    changed += [o for o in session.dirty if isinstance(o, SYNCED_MODELS) and session.is_modified(o)]
+    event_parents = {
+        o.patient_id for o in list(session.new) + list(session.dirty) + list(session.deleted)
+        if isinstance(o, Event) and o.patient_id is not None
+    }
+    if not changed and not event_parents: return
+
+    rev = next_sync_rev(session)
+    for o in changed:
+        o.sync_rev = rev
+    bump_patient_revs(session, rev, event_parents)
+
+# ---- CONTENT DIGEST ----
+# Each patient carries a digest of its clinical fields and events, so "did this
+# record change?" is a string comparison instead of a field-by-field diff over
+# lazily loaded events. Pushed payloads are digested with the same function.
+# Patients touched in a transaction are collected here and re-digested from the
+# database just before it commits; Core writes report their ids explicitly.
+DIGEST_FIELDS = ("team_id", "name", "age", "sex", "address", "regime", "remark")
+DIGEST_EVENT_FIELDS = ("original_start", "start", "title", "color", "missed_days", "remark", "outcome")
+
+def digest_value(value):
+    if value is None: return ""
+    if hasattr(value, "isoformat"): return value.isoformat()[:10]
+    return str(value)
+
+def content_digest(patient, events):
+    # patient / events: dicts or rows exposing DIGEST_FIELDS / DIGEST_EVENT_FIELDS
+    get = (lambda o, k: o.get(k)) if isinstance(patient, dict) else getattr
+    fields = [digest_value(get(patient, k)) for k in DIGEST_FIELDS]
+    evs = sorted(
+        [digest_value(e.get(k) if isinstance(e, dict) else getattr(e, k)) for k in DIGEST_EVENT_FIELDS]
+        for e in events
+    )
+    return hashlib.sha1(json.dumps([fields, evs]).encode()).hexdigest()
+
+def mark_content_changed(session, patient_ids):
+    session.info.setdefault("content_changed", set()).update(i for i in patient_ids if i is not None)
+
+def refresh_content_hashes(conn, patient_ids):
+    # Two queries per chunk: the patients, then their events
+    patient_t, event_t = Patient.__table__, Event.__table__
+    for chunk in chunked(patient_ids):
+        patients = conn.execute(db.select(patient_t.c.id, *[patient_t.c[k] for k in DIGEST_FIELDS]).where(patient_t.c.id.in_(chunk))).all()
+        events = {}
+        for row in conn.execute(db.select(event_t.c.patient_id, *[event_t.c[k] for k in DIGEST_EVENT_FIELDS]).where(event_t.c.patient_id.in_(chunk))):
+            events.setdefault(row.patient_id, []).append(row)
+        if patients:
+            conn.execute(
+                patient_t.update().where(patient_t.c.id == db.bindparam("p_id")).values(content_hash=db.bindparam("p_hash")),
+                [{"p_id": p.id, "p_hash": content_digest(p, events.get(p.id, []))} for p in patients]
+            )
+
+@sa_event.listens_for(Session, "after_flush")
+def collect_content_changes(session, flush_context):
+    ids = {o.id for o in session.new | session.dirty if isinstance(o, Patient) and session.is_modified(o)}
+    mark_content_changed(session, ids)
+
+@sa_event.listens_for(Session, "before_commit")
+def digest_changed_patients(session):
+    session.flush()
+    changed = session.info.pop("content_changed", None)
+    if changed: refresh_content_hashes(session.connection(), changed)
+
+@sa_event.listens_for(Session, "after_rollback")
+def forget_content_changes(session):
+    session.info.pop("content_changed", None)
 
 import socket
+import threading
 
 # ---- HELPER ----
-def get_unique_color():
-    base_colors = ["#FF5733", "#33FF57", "#3357FF", "#FF33A1", "#33FFF2", "#FFC733", "#8E44AD", "#F39C12", "#1ABC9C", "#2ECC71"]
-    used_colors = [e.color for e in Event.query.all()]
-    for c in base_colors:
-        if c not in used_colors:
-            return c
-    return random.choice(base_colors)  # fallback
+BULK_CHUNK = 500 # Keeps IN lists under SQLite's bound-parameter limit
+
+def chunked(seq, size=BULK_CHUNK):
+    seq = list(seq)
+    for i in range(0, len(seq), size):
+        yield seq[i:i + size]
+
+def select_in(stmt, column, values):
+    rows = []
+    for chunk in chunked(set(values)):
+        rows.extend(db.session.execute(stmt.where(column.in_(chunk))).all())
+    return rows
+
+def select_in_objects(model, column, values):
+    objs = []
+    for chunk in chunked(set(values)):
+        objs.extend(model.query.filter(column.in_(chunk)).all())
+    return objs
+
+def calendar_event_query():
+    # One joined, column-projected query for the calendar feed.
+    # Selecting plain columns (instead of Event objects) avoids the lazy
+    # per-row `e.patient` load, so the feed is a single round-trip.
+    return db.session.query(
+        Event.id, Event.title, Event.start, Event.color,
+        Event.missed_days, Event.remark, Event.outcome,
+        Patient.name, Patient.age, Patient.sex, Patient.address,
+        Patient.regime, Patient.remark.label("patient_remark")
+    ).join(Patient, Event.patient_id == Patient.id)
+
+def serialize_calendar_rows(rows):
+    # Build FullCalendar event dicts straight from calendar_event_query() rows
+    return [{
+        "id": r.id,
+        "title": f"{r.name} - {r.title}",
+        "start": wire_date(r.start),
+        "color": r.color,
+        "extendedProps": {
+            "patient": {
+                "name": r.name,
+                "age": r.age,
+                "sex": r.sex,
+                "address": r.address,
+                "regime": r.regime,
+                "remark": r.patient_remark
+            },
+            "missed_days": r.missed_days,
+            "remark": r.remark,
+            "outcome": r.outcome
+        }
+    } for r in rows]
+
+def parse_range_date(value):
+    # FullCalendar sends ISO strings ("2025-01-26" or "2025-01-26T00:00:00+06:30").
+    # Event.start is a DATE, so only the date part matters.
+    if not value: return None
+    return datetime.strptime(value[:10], "%Y-%m-%d").date()
 
 def get_local_ip():
     try:
@@ -89,14 +363,261 @@ def get_local_ip():
     except:
         return "127.0.0.1"
 
+# ---- HOST ADDRESS ----
+# The share URL on the index page needs this machine's LAN address. Resolving it
+# opens a socket, so it is done off the request path: once at startup, then on a
+# background timer to follow network changes. HOST_IP pins it (no discovery).
+HOST_IP_REFRESH_SECONDS = int(os.environ.get("HOST_IP_REFRESH_SECONDS", 300))
+HOST_IP = {"value": os.environ.get("HOST_IP"), "refresher": None}
+HOST_IP_LOCK = threading.Lock()
+
+def refresh_host_ip():
+    HOST_IP["value"] = os.environ.get("HOST_IP") or get_local_ip()
+
+def start_host_ip_refresher():
+    with HOST_IP_LOCK:
+        if HOST_IP["refresher"] or os.environ.get("HOST_IP"): return
+
+        def loop():
+            while True:
+                refresh_host_ip()
+                time.sleep(HOST_IP_REFRESH_SECONDS)
+
+        HOST_IP["refresher"] = threading.Thread(target=loop, name="host-ip-refresh", daemon=True)
+        HOST_IP["refresher"].start()
+
+def get_share_url():
+    # Never blocks: if discovery has not finished yet, fall back to localhost
+    start_host_ip_refresher()
+    port = int(os.environ.get("PORT", 5000))
+    return f"http://{HOST_IP['value'] or '127.0.0.1'}:{port}"
+
+# ---- COLOUR ALLOCATOR ----
+# team_id -> (expires_at, Counter{colour: patients using it})
+# Seeded by one grouped query over the team's own events, then kept current in
+# memory as colours are handed out, so allocating no longer scans Event.
+BASE_COLORS = ["#FF5733", "#33FF57", "#3357FF", "#FF33A1", "#33FFF2", "#FFC733", "#8E44AD", "#F39C12", "#1ABC9C", "#2ECC71"]
+COLOR_USAGE_TTL = 600
+COLOR_USAGE = {}
+
+def get_color_usage(team_id):
+    now = time.monotonic()
+    cached = COLOR_USAGE.get(team_id)
+    if cached and cached[0] > now:
+        return cached[1]
+
+    rows = db.session.query(Event.color, db.func.count(db.distinct(Event.patient_id)))\
+        .join(Patient, Event.patient_id == Patient.id)\
+        .filter(Patient.team_id == team_id, Event.color.in_(BASE_COLORS))\
+        .group_by(Event.color).all()
+    usage = Counter({c: 0 for c in BASE_COLORS})
+    usage.update(dict(rows))
+    COLOR_USAGE[team_id] = (now + COLOR_USAGE_TTL, usage)
+    return usage
+
+def get_unique_color(team_id="DEFAULT"):
+    # Least-used colour in the team; ties go to BASE_COLORS order, so unused
+    # colours are handed out first exactly as before
+    usage = get_color_usage(team_id)
+    color = min(BASE_COLORS, key=lambda c: usage[c])
+    usage[color] += 1
+    return color
+
+# ---- MEMBERSHIP CACHE ----
+# device_id -> (members_rev, [(team_slug, status, role), ...])
+# Clients poll every 60s, so the "which teams may this device see" check is the
+# most frequent question in the app. Answer it from memory while the shared
+# members_rev (bumped in the database by any membership write, from any worker)
+# is unchanged; a one-row read replaces the per-device query. Devices with no
+# memberships are not cached, and a new revision starts an empty cache, so it
+# never holds more than the devices known to team_member.
+MEMBERSHIP_CACHE = {"rev": None, "devices": {}}
+
+def get_device_memberships(device_id):
+    if not device_id: return []
+    rev = current_members_rev()
+    if MEMBERSHIP_CACHE["rev"] != rev:
+        MEMBERSHIP_CACHE.update(rev=rev, devices={})
+    cached = MEMBERSHIP_CACHE["devices"].get(device_id)
+    if cached and cached[0] == rev:
+        return cached[1]
+
+    rows = db.session.query(TeamMember.team_slug, TeamMember.status, TeamMember.role)\
+        .filter(TeamMember.device_id == device_id).all()
+    memberships = [tuple(r) for r in rows]
+    if memberships:
+        # Tagged with the revision read before the query, so a concurrent reset
+        # never keeps rows older than the revision they are served under
+        MEMBERSHIP_CACHE["devices"][device_id] = (rev, memberships)
+    return memberships
+
+def get_authorized_slugs(device_id):
+    return [slug for slug, status, _ in get_device_memberships(device_id) if status == 'APPROVED']
+
+# ---- TEAM DIRECTORY ----
+# Public teams change rarely but the directory is browsed often, so it is served
+# from a snapshot: one grouped query builds {slug: entry} and every sort order
+# (a pre-sorted slug list) at once. A snapshot is never mutated once published;
+# changes build a new one and swap the single reference, so a request that reads
+# DIRECTORY["snapshot"] once always sees teams and orders from the same build.
+# Joins and leaves copy the snapshot with one count adjusted (only the
+# member-count order is re-sorted); creating or disbanding a team drops it.
+# The TTL bounds staleness across workers.
+DIRECTORY_CACHE_TTL = int(os.environ.get("DIRECTORY_CACHE_TTL", 300))
+DirectorySnapshot = namedtuple("DirectorySnapshot", "expires_at teams orders")
+DIRECTORY = {"snapshot": None}
+DIRECTORY_LOCK = threading.Lock()
+DIRECTORY_SORTS = {
+    # sort -> (key, descending); slug breaks ties so keyset positions are stable
+    "alphabet": (lambda e: (e["name"], e["slug"]), False),
+    "created": (lambda e: (e["created_at"] or datetime.min, e["slug"]), True),
+    "active": (lambda e: (e["updated_at"] or datetime.min, e["slug"]), True),
+    "count": (lambda e: (e["member_count"], e["slug"]), True),
+}
+
+def sort_directory(teams, sort_by):
+    # -> ([slug, ...] in display order, {slug: position})
+    key, descending = DIRECTORY_SORTS[sort_by]
+    slugs = sorted(teams, key=lambda slug: key(teams[slug]), reverse=descending)
+    return slugs, {slug: i for i, slug in enumerate(slugs)}
+
+def get_directory():
+    snapshot = DIRECTORY["snapshot"]
+    if snapshot and snapshot.expires_at > time.monotonic():
+        return snapshot
+    with DIRECTORY_LOCK:
+        # Another thread may have rebuilt it while we waited
+        snapshot = DIRECTORY["snapshot"]
+        if snapshot and snapshot.expires_at > time.monotonic():
+            return snapshot
+        rows = db.session.query(
+            Team.slug, Team.name, Team.created_at, Team.updated_at, Team.invite_code,
+            db.func.count(TeamMember.id).label("member_count")
+        ).outerjoin(TeamMember, Team.slug == TeamMember.team_slug)\
+            .filter(Team.is_public == True)\
+            .group_by(Team.id).all()
+        teams = {r.slug: r._asdict() for r in rows}
+        snapshot = DirectorySnapshot(
+            expires_at=time.monotonic() + DIRECTORY_CACHE_TTL, teams=teams,
+            orders={sort_by: sort_directory(teams, sort_by) for sort_by in DIRECTORY_SORTS})
+        DIRECTORY["snapshot"] = snapshot
+        return snapshot
+
+def invalidate_directory(slug=None, member_delta=0):
+    with DIRECTORY_LOCK:
+        snapshot = DIRECTORY["snapshot"]
+        if not member_delta:
+            DIRECTORY["snapshot"] = None
+            return
+        # A private team (or an unbuilt snapshot) has nothing to adjust
+        entry = snapshot.teams.get(slug) if snapshot else None
+        if entry:
+            teams = {**snapshot.teams, slug: {**entry, "member_count": entry["member_count"] + member_delta}}
+            DIRECTORY["snapshot"] = snapshot._replace(
+                teams=teams, orders={**snapshot.orders, "count": sort_directory(teams, "count")})
+
+# ---- REGIME SCHEDULES ----
+# Built-in schedules: milestone label -> day offset from the treatment start.
+# Rows in the Regime table add new codes without a code change. Regimes are
+# shared by every team, so save_regime refuses the built-in codes.
+DEFAULT_REGIMES = {
+    "IR": {"Start": 0, "M2": 56, "M5": 140, "M6/M-end": 168},
+    "CR": {"Start": 0, "M2": 56, "M5": 140, "M6/M-end": 168},
+    "RR": {"Start": 0, "M3": 84, "M5": 140, "M8/M-end": 224},
+}
+FALLBACK_MILESTONES = {"Start": 0, "M1": 0} # unknown regime
+REGIME_CACHE_TTL = 300
+REGIME_CACHE = {} # "expires_at" -> float, "schedules" -> {CODE: ((label, timedelta, outcome), ...)}
+
+def regime_key(regime):
+    return (regime or "").strip().upper()
+
+def default_outcome(label):
+    # Start gets "Start", M-end gets "Cured", others empty
+    if label == "Start": return "Start"
+    if "M-end" in label: return "Cured"
+    return ""
+
+def compile_schedule(milestones):
+    # [(label, offset)] -> tuple of (label, timedelta, default outcome), computed once
+    return tuple((label, timedelta(days=offset), default_outcome(label)) for label, offset in milestones)
+
+def get_regime_schedules():
+    now = time.monotonic()
+    if REGIME_CACHE.get("expires_at", 0) > now:
+        return REGIME_CACHE["schedules"]
+
+    schedules = {code: compile_schedule(m.items()) for code, m in DEFAULT_REGIMES.items()}
+    for r in Regime.query.all():
+        schedules[r.code] = compile_schedule((m["label"], m["offset"]) for m in json.loads(r.milestones))
+    REGIME_CACHE.update(expires_at=now + REGIME_CACHE_TTL, schedules=schedules)
+    return schedules
+
+def invalidate_regimes():
+    REGIME_CACHE.clear()
+
+FALLBACK_SCHEDULE = compile_schedule(FALLBACK_MILESTONES.items())
+
+def build_milestones(regime, start_date, color, remark):
+    # Event field dicts (no patient_id) for a new patient's schedule
+    schedule = get_regime_schedules().get(regime_key(regime), FALLBACK_SCHEDULE)
+    return [{
+        "title": label,
+        "start": start_date + offset,
+        "original_start": start_date + offset,
+        "color": color,
+        "missed_days": 0,
+        "remark": remark,  # copy from patient
+        "outcome": outcome
+    } for label, offset, outcome in schedule]
+
 # ---- ROUTES ----
+PATIENT_PAGE_SIZE = 50
+
+def patient_summaries(after_id=0, limit=PATIENT_PAGE_SIZE, team_ids=None):
+    # Keyset page of registry rows (patients with at least one milestone), plus
+    # each patient's first and latest milestone from one grouped event fetch.
+    # team_ids=None means every team. Returns (rows, next_after) where
+    # next_after is None on the last page.
+    query = db.session.query(Patient.id, Patient.uid, Patient.name, Patient.age, Patient.sex, Patient.regime)\
+        .filter(Patient.id > after_id, Patient.events.any())
+    if team_ids is not None:
+        query = query.filter(Patient.team_id.in_(team_ids))
+    page = query.order_by(Patient.id).limit(limit + 1).all()
+    has_more = len(page) > limit
+    page = page[:limit]
+
+    first, latest = {}, {}
+    events = db.session.query(Event.patient_id, Event.start, Event.color, Event.outcome)\
+        .filter(Event.patient_id.in_([r.id for r in page]))\
+        .order_by(Event.patient_id, Event.start, Event.id).all()
+    for e in events:
+        first.setdefault(e.patient_id, e)
+        latest[e.patient_id] = e
+
+    rows = [{
+        "id": r.id, "uid": r.uid, "name": r.name, "age": r.age, "sex": r.sex, "regime": r.regime,
+        "start": wire_date(first[r.id].start), "color": first[r.id].color,
+        "last_outcome": latest[r.id].outcome or ""
+    } for r in page]
+    return rows, (page[-1].id if has_more else None)
+
 @app.route("/")
 def index():
-    patients = Patient.query.all()
-    host_ip = get_local_ip()
-    port = int(os.environ.get("PORT", 5000))
-    share_url = f"http://{host_ip}:{port}"
-    return render_template("index.html", patients=patients, share_url=share_url)
+    patients, next_after = patient_summaries()
+    # The registry is one page; the header counts need the real total
+    total_patients = db.session.query(db.func.count(Patient.id)).scalar()
+    return render_template("index.html", patients=patients, next_after=next_after, total_patients=total_patients, share_url=get_share_url())
+
+@app.route("/api/patients")
+def list_patients_page():
+    # Infinite scroll for the registry sidebar: ?after=<last id>&limit=N
+    after_id = request.args.get('after', 0, type=int)
+    limit = min(max(request.args.get('limit', PATIENT_PAGE_SIZE, type=int), 1), 200)
+    # Same visibility as the other data endpoints: approved teams plus DEFAULT
+    team_ids = get_authorized_slugs(request.headers.get('X-Device-ID')) + ['DEFAULT']
+    patients, next_after = patient_summaries(after_id, limit, team_ids)
+    return jsonify(success=True, patients=patients, next_after=next_after)
 
 @app.route("/events")
 def events():
@@ -104,10 +625,7 @@ def events():
     requester_device = request.headers.get('X-Device-ID')
     
     # 1. Determine authorized teams for this device
-    authorized_slugs = []
-    if requester_device:
-        memberships = TeamMember.query.filter_by(device_id=requester_device, status='APPROVED').all()
-        authorized_slugs = [m.team_slug for m in memberships]
+    authorized_slugs = get_authorized_slugs(requester_device)
 
     # 2. Filtering Logic
     if team_slug and team_slug != 'ALL' and team_slug != 'DEFAULT':
@@ -118,34 +636,34 @@ def events():
         if team_slug not in authorized_slugs:
              return jsonify(error="Unauthorized: Not an approved member of this team"), 403
 
-        events = Event.query.join(Patient).filter(Patient.team_id == team_slug).all()
+        query = calendar_event_query().filter(Patient.team_id == team_slug)
     else:
         # Global View: Return only data from teams I am a member of
         if not authorized_slugs:
             # If guest or not in any teams, return empty instead of "all"
             return jsonify([])
         
-        events = Event.query.join(Patient).filter(Patient.team_id.in_(authorized_slugs)).all()
-        
-    return jsonify([{
-        "id": e.id,
-        "title": f"{e.patient.name} - {e.title}",
-        "start": e.start,
-        "color": e.color,
-        "extendedProps": {
-            "patient": {
-                "name": e.patient.name,
-                "age": e.patient.age,
-                "sex": e.patient.sex,
-                "address": e.patient.address,
-                "regime": e.patient.regime,
-                "remark": e.patient.remark
-            },
-            "missed_days": e.missed_days,
-            "remark": e.remark,
-            "outcome": e.outcome
-        }
-    } for e in events])
+        query = calendar_event_query().filter(Patient.team_id.in_(authorized_slugs))
+
+    # 3. Date Window (FullCalendar sends start/end on every view change)
+    try:
+        range_start = parse_range_date(request.args.get('start'))
+        range_end = parse_range_date(request.args.get('end'))
+    except ValueError:
+        return jsonify(error="Invalid Date Format"), 400
+    if range_start: query = query.filter(Event.start >= range_start)
+    if range_end: query = query.filter(Event.start < range_end)
+
+    # 4. Optional Cap/Paging (e.g. ?limit=500&page=2)
+    limit = request.args.get('limit', type=int)
+    if not limit:
+        return jsonify(serialize_calendar_rows(query.all()))
+
+    page = max(request.args.get('page', 1, type=int), 1)
+    rows = query.order_by(Event.start, Event.id).offset((page - 1) * limit).limit(limit + 1).all()
+    response = jsonify(serialize_calendar_rows(rows[:limit]))
+    response.headers['X-Has-More'] = '1' if len(rows) > limit else '0'
+    return response
 
 @app.route("/add_patient", methods=["POST"])
 def add_patient():
@@ -160,66 +678,181 @@ def add_patient():
         team_id=request.form.get("team_id", "DEFAULT") # Capture Team ID
     )
     db.session.add(p)
-    db.session.commit()
+    db.session.flush() # get ID; patient and milestones commit together
 
     # Cycle info
-    start_date = datetime.strptime(request.form["start_date"], "%Y-%m-%d")
-    #missed_days = int(request.form.get("missed_days", 0))
-
-    # Correct milestones by regime
-    regime = p.regime.upper()
-    if regime in ["IR", "CR"]:
-        milestones = {
-            "Start": 0,   # start day
-            "M2": 56,
-            "M5": 140,
-            "M6/M-end": 168
-        }
-    elif regime == "RR":
-        milestones = {
-            "Start": 0,   # start day
-            "M3": 84,
-            "M5": 140,
-            "M8/M-end": 224
-        }
-    else:
-        milestones = {"Start": 0, "M1": 0}   # fallback for unknown regime
+    start_date = datetime.strptime(request.form["start_date"], "%Y-%m-%d").date()
+    color = get_unique_color(p.team_id)
 
-    color = get_unique_color()
-
-    for label, offset in milestones.items():
-        # Apply +missed_days only to M-x (not M-end)
-        #m_missed = missed_days if "M-end" not in label else 0
-        m_missed = 0
-        d = start_date + timedelta(days=offset + m_missed)
-        
-        # Default outcome
-        # Default outcome: Start gets "Start", M-end gets "Cured", others empty
-        if label == "Start":
-            outcome_default = "Start"
-        elif "M-end" in label:
-            outcome_default = "Cured"
-        else:
-            outcome_default = ""
-        
-        ev = Event(
-            id=None,  # optional, SQLAlchemy auto-increments
-            title=label,
-            start=d.strftime("%Y-%m-%d"),
-            original_start=d.strftime("%Y-%m-%d"),
-            color=color,
-            patient_id=p.id,
-            missed_days=m_missed,
-            remark=p.remark,  # copy from patient
-            outcome=outcome_default
-        )
-        db.session.add(ev)
+    for e in build_milestones(p.regime, start_date, color, p.remark):
+        db.session.add(Event(patient_id=p.id, **e))
 
     db.session.commit()
     return redirect(url_for("index"))
 
+@app.route("/api/patients/batch", methods=["POST"])
+def add_patients_batch():
+    # Bulk intake (e.g. a clinic's weekly CSV): { "team_id": "...", "patients": [
+    #   {name, age, sex, address, regime, remark, start_date, team_id?}, ...] }
+    # All-or-nothing: one transaction, bulk inserts, returns the created uids.
+    try:
+        req = request.get_json(force=True)
+        rows = req.get("patients", [])
+        default_team = req.get("team_id", "DEFAULT")
+        requester_device = request.headers.get('X-Device-ID')
+
+        # Security Check: Must be APPROVED member of every non-default team written to
+        authorized_slugs = get_authorized_slugs(requester_device)
+        for team_id in {r.get("team_id", default_team) for r in rows}:
+            if team_id != 'DEFAULT' and team_id not in authorized_slugs:
+                return jsonify(success=False, message=f"Unauthorized: Not an approved member of {team_id}"), 403
+
+        to_insert = []
+        for i, r in enumerate(rows):
+            try:
+                team_id = r.get("team_id", default_team)
+                p_in = {
+                    "uid": r.get("uid") or str(uuid.uuid4()),
+                    "team_id": team_id,
+                    "name": r["name"].strip(), "age": int(r["age"]), "sex": r["sex"],
+                    "address": r.get("address", ""), "regime": r["regime"], "remark": r.get("remark", "")
+                }
+                start_date = datetime.strptime(r["start_date"], "%Y-%m-%d").date()
+            except (KeyError, ValueError, TypeError, AttributeError) as e:
+                return jsonify(success=False, message=f"Invalid patient at row {i}: {e}"), 400
+
+            p_in["events"] = build_milestones(p_in["regime"], start_date, get_unique_color(team_id), p_in["remark"])
+            to_insert.append(p_in)
+
+        insert_patients(to_insert, next_sync_rev(db.session))
+        db.session.commit()
+        return jsonify(success=True, count=len(to_insert), uids=[p_in["uid"] for p_in in to_insert])
+
+    except Exception as e:
+        db.session.rollback()
+        return jsonify(success=False, message=str(e)), 500
+
+@app.route("/api/regimes", methods=["GET"])
+def list_regimes():
+    schedules = get_regime_schedules()
+    return jsonify(success=True, regimes=[
+        {"code": code, "milestones": [{"label": label, "offset": offset.days} for label, offset, _ in schedule]}
+        for code, schedule in sorted(schedules.items())
+    ])
+
+@app.route("/api/regimes", methods=["POST"])
+def save_regime():
+    # Create/replace a regime: { "code": "BPaL (Short Course)", "name": "...",
+    #   "milestones": [{"label": "Start", "offset": 0}, ..., {"label": "M6/M-end", "offset": 182}] }
+    requester_device = request.headers.get('X-Device-ID')
+    if not any(role == 'ADMIN' for _, status, role in get_device_memberships(requester_device) if status == 'APPROVED'):
+        return jsonify(success=False, message="Unauthorized: Only Team Admins can edit regimes."), 403
+
+    data = request.json
+    code = regime_key(data.get("code"))
+    try:
+        milestones = [{"label": str(m["label"]).strip(), "offset": int(m["offset"])} for m in data.get("milestones", [])]
+    except (KeyError, ValueError, TypeError):
+        return jsonify(success=False, message="Each milestone needs a label and an integer offset"), 400
+    if not code or not milestones:
+        return jsonify(success=False, message="Code and milestones required"), 400
+    if code in DEFAULT_REGIMES:
+        # Regimes are shared by every team; the built-in ones are not editable
+        return jsonify(success=False, message=f"{code} is a built-in regime and cannot be changed"), 400
+    if any(not m["label"] or m["offset"] < 0 for m in milestones):
+        return jsonify(success=False, message="Milestone labels must be set and offsets non-negative"), 400
+
+    regime = Regime.query.filter_by(code=code).first()
+    if not regime:
+        regime = Regime(code=code)
+        db.session.add(regime)
+    regime.name = data.get("name") or data.get("code")
+    regime.milestones = json.dumps(sorted(milestones, key=lambda m: m["offset"]))
+    db.session.commit()
+    invalidate_regimes()
+    return jsonify(success=True, code=code)
+
+@app.route("/api/patients/<uid>/regenerate", methods=["POST"])
+def regenerate_schedule(uid):
+    # Rebuild a patient's milestones from the current regime schedule. The start
+    # date defaults to the patient's existing "Start" (or earliest) milestone.
+    try:
+        p = Patient.query.filter_by(uid=uid).first()
+        if not p: return jsonify(success=False, message="Patient not found"), 404
+        # Never overwrite real milestones with the fallback schedule
+        if regime_key(p.regime) not in get_regime_schedules():
+            return jsonify(success=False, message=f"Unknown regime: {p.regime}"), 400
+
+        requester_device = request.headers.get('X-Device-ID')
+        if p.team_id != 'DEFAULT' and p.team_id not in get_authorized_slugs(requester_device):
+            return jsonify(success=False, message="Unauthorized: Not an approved member of this team"), 403
+
+        data = request.get_json(silent=True) or {}
+        if data.get("start_date"):
+            start_date = datetime.strptime(data["start_date"], "%Y-%m-%d").date()
+        else:
+            existing = sorted(p.events, key=lambda e: (e.title != "Start", e.original_start))
+            if not existing: return jsonify(success=False, message="start_date required"), 400
+            start_date = existing[0].original_start
+
+        color = p.events[0].color if p.events else get_unique_color(p.team_id)
+        p.events = [Event(**e) for e in build_milestones(p.regime, start_date, color, p.remark)]
+        db.session.commit()
+        return jsonify(success=True, events=len(p.events))
+    except ValueError:
+        db.session.rollback()
+        return jsonify(success=False, message="Invalid Date Format"), 400
+    except Exception as e:
+        db.session.rollback()
+        return jsonify(success=False, message=str(e)), 500
+
 from flask import request
 
+def shift_days(column, days):
+    # SQL expression for a DATE column moved by `days`, evaluated in the database
+    # (SQLite keeps dates as ISO text, so it needs its date() modifier form)
+    if db.engine.dialect.name == "sqlite":
+        return db.func.date(column, f"{days:+d} days")
+    return column + days
+
+def apply_event_edit(ev, missed_days, remark, outcome):
+    # Returns an error message, or None once the edit (and its ripple) is applied
+
+    # Validate outcome
+    if "M-end" in ev.title:
+        valid_outcomes = ["", "Cured", "Completed","Failed", "LTFU", "Died"]
+    else:
+        # Allow "Start" so the initial milestone can be edited without 400 error
+        valid_outcomes = ["", "Start", "Failed", "LTFU", "Died"]
+
+    if outcome not in valid_outcomes:
+        return "Invalid outcome for this milestone"
+
+    # Update fields
+    old_missed_days = ev.missed_days or 0
+    ev.missed_days = missed_days
+    ev.remark = remark
+    ev.outcome = outcome
+
+    # 'missed_days' is the TOTAL offset of this milestone from its original date,
+    # so this event moves to original_start + missed_days...
+    ev.start = ev.original_start + timedelta(days=missed_days)
+
+    # ...and every later milestone of the patient slips by the CHANGE in missed
+    # days. Their original_start moves too, so the shift persists if that event
+    # is edited later. One set-based UPDATE, computed in the database.
+    delta_days = missed_days - old_missed_days
+    if delta_days != 0:
+        db.session.execute(
+            db.update(Event)
+            .where(Event.patient_id == ev.patient_id, Event.original_start > ev.original_start)
+            .values(start=shift_days(Event.start, delta_days),
+                    original_start=shift_days(Event.original_start, delta_days)),
+            # Expire any loaded later events so batch edits see the shifted dates
+            execution_options={"synchronize_session": "fetch"}
+        )
+    return None
+
 @app.route("/update_event", methods=["POST"])
 def update_event():
     try:
@@ -234,81 +867,48 @@ def update_event():
         if not ev:
             return jsonify(success=False, message="Event not found"), 404
 
-        # Validate outcome
-        if "M-end" in ev.title:
-            valid_outcomes = ["", "Cured", "Completed","Failed", "LTFU", "Died"]
-        else:
-            # Allow "Start" so the initial milestone can be edited without 400 error
-            valid_outcomes = ["", "Start", "Failed", "LTFU", "Died"]
+        error = apply_event_edit(ev, missed_days, remark, outcome)
+        if error:
+            return jsonify(success=False, message=error), 400
 
-        if outcome not in valid_outcomes:
-            return jsonify(success=False, message="Invalid outcome for this milestone"), 400
+        db.session.commit()
+        return jsonify(success=True)
 
-        # Update fields
-        old_missed_days = ev.missed_days
-        ev.missed_days = missed_days
-        ev.remark = remark
-        ev.outcome = outcome
+    except Exception as e:
+        db.session.rollback()
+        print("Error updating event:", e)
+        return jsonify(success=False, message=str(e)), 500
 
-        # Calculate shift delta
-        delta_days = missed_days - old_missed_days
-        
-        # Shift CURRENT event
-        # Logic: We treat 'missed_days' on this event as adding to the delay.
-        # But wait, the existing code says: new_start = original_start + missed_days
-        # This implies 'missed_days' is the TOTAL offset for this event? 
-        # No, usually in these apps, you report "5 days missed during this period".
-        # If the user enters "5" in the input, they mean "Total 5 days missed for this specific event milestone".
-        # So we update this event's date based on its original start.
-        
-        current_original_start = datetime.strptime(ev.original_start, "%Y-%m-%d")
-        new_start_date = current_original_start + timedelta(days=missed_days)
-        
-        # ACTUALLY, checking previous code: 
-        # new_start = original_start + timedelta(days=missed_days)
-        # This means 'missed_days' is indeed treated as the offset from original.
-        # But if we want RIPPLE effect, checking "5" here should push EVERYTHING else by the difference.
-        
-        # So if I change missed_days from 0 to 5 (delta +5):
-        # This event moves +5 days.
-        # ALL FUTURE events should also move +5 days from their CURRENT position.
-        
-        ev.start = new_start_date.strftime("%Y-%m-%d")
-
-        if delta_days != 0:
-            # Find all future events for this patient
-            # We assume 'future' means original_start is after this event's original_start
-            future_events = Event.query.filter(
-                Event.patient_id == ev.patient_id,
-                Event.original_start > ev.original_start
-            ).all()
-
-            for fev in future_events:
-                # Shift their CURRENT start date by delta
-                # We do NOT update their 'missed_days' (that belongs to them localy), 
-                # we just shift their schedule.
-                # But wait, if we only update 'start', and later someone edits that event, 
-                # the code `new_start = original_start + missed_days` would RESET this shift!
-                
-                # PROBLEM: The current logic relies on `original_start + missed_days`.
-                # If we want a permanent shift, we must update `original_start` of future events?
-                # YES. If the schedule slips, the "baseline" for future events has effectively changed.
-                
-                fev_current_start = datetime.strptime(fev.start, "%Y-%m-%d")
-                fev_new_start = fev_current_start + timedelta(days=delta_days)
-                fev.start = fev_new_start.strftime("%Y-%m-%d")
-                
-                # Crucial: We must also update original_start so the shift persists 
-                # if the user later edits that future event.
-                fev_original = datetime.strptime(fev.original_start, "%Y-%m-%d")
-                fev_new_original = fev_original + timedelta(days=delta_days)
-                fev.original_start = fev_new_original.strftime("%Y-%m-%d")
+@app.route("/update_events_batch", methods=["POST"])
+def update_events_batch():
+    # Bulk adherence corrections: { "edits": [{id, missed_days, remark, outcome}, ...] }
+    # Applied in order, all-or-nothing, in one transaction.
+    try:
+        edits = request.get_json(force=True).get("edits", [])
+        events_by_id = {
+            ev.id: ev for ev in select_in_objects(Event, Event.id, [int(ed.get("id")) for ed in edits])
+        }
+
+        for i, ed in enumerate(edits):
+            ev = events_by_id.get(int(ed.get("id")))
+            if not ev:
+                db.session.rollback()
+                return jsonify(success=False, message=f"Event not found (edit {i})"), 404
+
+            error = apply_event_edit(
+                ev, int(ed.get("missed_days", 0)),
+                (ed.get("remark") or "").strip(), (ed.get("outcome") or "").strip()
+            )
+            if error:
+                db.session.rollback()
+                return jsonify(success=False, message=f"{error} (edit {i})"), 400
 
         db.session.commit()
-        return jsonify(success=True)
+        return jsonify(success=True, updated=len(edits))
 
     except Exception as e:
-        print("Error updating event:", e)
+        db.session.rollback()
+        print("Error updating events:", e)
         return jsonify(success=False, message=str(e)), 500
 
 @app.route("/delete_patient/<int:patient_id>", methods=["POST"])
@@ -318,7 +918,7 @@ def delete_patient(patient_id):
         if p:
             # Create Tombstone
             if p.uid:
-                dr = DeletedRecord(uid=p.uid)
+                dr = DeletedRecord(uid=p.uid, team_id=p.team_id)
                 db.session.add(dr)
             
             db.session.delete(p)
@@ -332,18 +932,125 @@ def delete_patient(patient_id):
 
 # ---- SYNC API ----
 
+SYNC_STREAM_BATCH = 500 # Patients per cursor batch in NDJSON mode
+
+def serialize_patient(p):
+    return {
+        "uid": p.uid,
+        "team_id": p.team_id,
+        "updated_at": p.updated_at.isoformat() if p.updated_at else None,
+        "digest": p.content_hash,
+        "name": p.name, "age": p.age, "sex": p.sex, 
+        "address": p.address, "regime": p.regime, "remark": p.remark,
+        "events": [{
+            "id": e.id,
+            "updated_at": e.updated_at.isoformat() if e.updated_at else None,
+            "title": e.title, "start": wire_date(e.start), "original_start": wire_date(e.original_start),
+            "color": e.color, "missed_days": e.missed_days, 
+            "remark": e.remark, "outcome": e.outcome
+        } for e in p.events]
+    }
+
+def serialize_team(t):
+    return {"slug": t.slug, "name": t.name, "created_at": t.created_at.isoformat() if t.created_at else None}
+
+def serialize_member(m):
+    return {
+        "team_slug": m.team_slug, "user_name": m.user_name, 
+        "device_id": m.device_id, "status": m.status,
+        "updated_at": m.updated_at.isoformat() if m.updated_at else None
+    }
+
+def stream_sync_ndjson(patients, deleted, teams, members, stats, sync_cursor, reset):
+    # Line types: meta (first), patient, deleted, team, member, end (last).
+    # The client can start applying patients before the last byte arrives.
+    def generate():
+        yield json.dumps({"type": "meta", "success": True, "timestamp": datetime.utcnow().isoformat(), "cursor": sync_cursor, "reset": reset, "stats": stats}) + "\n"
+        count = 0
+        for p in patients:
+            yield json.dumps({"type": "patient", **serialize_patient(p)}) + "\n"
+            count += 1
+        for uid in deleted:
+            yield json.dumps({"type": "deleted", "uid": uid}) + "\n"
+        for t in teams:
+            yield json.dumps({"type": "team", **serialize_team(t)}) + "\n"
+        for m in members:
+            yield json.dumps({"type": "member", **serialize_member(m)}) + "\n"
+        yield json.dumps({"type": "end", "count": count}) + "\n"
+
+    return Response(stream_with_context(generate()), mimetype="application/x-ndjson")
+
+# ---- TOMBSTONE COMPACTION ----
+# A tombstone can go once every approved member of its team has acknowledged a
+# cursor past it. Tombstones older than TOMBSTONE_MAX_AGE_DAYS go regardless
+# (lost devices would otherwise pin them forever). Either way compacted_rev
+# records the highest revision removed, so any cursor below it is answered
+# with a full sync instead. Acknowledgements come only from explicit cursors.
+TOMBSTONE_MAX_AGE_DAYS = int(os.environ.get("TOMBSTONE_MAX_AGE_DAYS", 90))
+TOMBSTONE_COMPACT_INTERVAL = 600 # Seconds between compaction passes (per process)
+LAST_TOMBSTONE_COMPACTION = 0
+
+def acknowledge_sync(device_id, team_slugs, ack_rev):
+    # Only an explicit cursor proves what a client has applied. The common poll
+    # from an up-to-date device finds nothing to record and writes nothing, so
+    # read polls never take SQLite's write lock.
+    if not device_id or not team_slugs: return
+    member_t = TeamMember.__table__
+    behind = db.and_(member_t.c.device_id == device_id, member_t.c.team_slug.in_(team_slugs),
+                     or_(member_t.c.synced_rev.is_(None), member_t.c.synced_rev < ack_rev))
+    wrote = False
+    if db.session.execute(db.select(member_t.c.id).where(behind).limit(1)).first():
+        db.session.execute(
+            member_t.update().where(behind)
+            # Keep updated_at: an acknowledgement is not a membership change
+            .values(synced_rev=ack_rev, updated_at=member_t.c.updated_at)
+        )
+        wrote = True
+    if maybe_compact_tombstones(): wrote = True
+    if wrote: db.session.commit()
+
+def maybe_compact_tombstones():
+    global LAST_TOMBSTONE_COMPACTION
+    now = time.monotonic()
+    if now - LAST_TOMBSTONE_COMPACTION < TOMBSTONE_COMPACT_INTERVAL: return False
+    LAST_TOMBSTONE_COMPACTION = now
+    compact_tombstones()
+    return True
+
+def compact_tombstones():
+    tomb_t, counter_t = DeletedRecord.__table__, SyncCounter.__table__
+    member_t = TeamMember.__table__
+
+    # 1. Acknowledged by every approved member of the team
+    horizon = db.select(db.func.min(member_t.c.synced_rev))\
+        .where(member_t.c.team_slug == tomb_t.c.team_id, member_t.c.status == 'APPROVED')\
+        .scalar_subquery()
+    # 2. Expired by age
+    cutoff = datetime.utcnow() - timedelta(days=TOMBSTONE_MAX_AGE_DAYS)
+
+    # Any cursor below a removed tombstone (a device outside the team, or one
+    # that never acknowledged) must be answered with a full sync from now on
+    doomed = or_(tomb_t.c.sync_rev <= horizon, tomb_t.c.timestamp < cutoff)
+    removed_rev = db.session.execute(db.select(db.func.max(tomb_t.c.sync_rev)).where(doomed)).scalar()
+    if removed_rev is None: return
+    db.session.execute(
+        counter_t.update()
+        .where(counter_t.c.id == 1, or_(counter_t.c.compacted_rev.is_(None), counter_t.c.compacted_rev < removed_rev))
+        .values(compacted_rev=removed_rev)
+    )
+    db.session.execute(tomb_t.delete().where(doomed))
+
 # 1. Export Data (Host gives data to Guest)
-@app.route("/api/get_all_data")
+@app.route("/api/get_all_data", methods=["GET", "POST"])
 def get_all_data():
     target_team = request.args.get('team')
     since_str = request.args.get('since')
+    # POST {"digests": {uid: digest}}: reply with only the records that differ
+    digests = (request.get_json(silent=True) or {}).get("digests") if request.method == "POST" else None
     requester_device = request.headers.get('X-Device-ID')
     
     # 1. Determine authorized teams for this device
-    authorized_slugs = []
-    if requester_device:
-        memberships = TeamMember.query.filter_by(device_id=requester_device, status='APPROVED').all()
-        authorized_slugs = [m.team_slug for m in memberships]
+    authorized_slugs = get_authorized_slugs(requester_device)
 
     # 2. Security & Filtering Setup
     query = Patient.query
@@ -363,256 +1070,457 @@ def get_all_data():
              return jsonify(error="Unauthorized: Not an approved member of this team"), 403
 
         # Admin Stats for Notifications
-        admin_membership = TeamMember.query.filter_by(team_slug=target_team, device_id=requester_device, role='ADMIN').first()
-        if admin_membership:
+        is_admin = any(slug == target_team and role == 'ADMIN' for slug, _, role in get_device_memberships(requester_device))
+        if is_admin:
             pending_count = TeamMember.query.filter_by(team_slug=target_team, status='PENDING').count()
 
         # Filter patients by specific team
         query = query.filter_by(team_id=target_team)
+        synced_slugs = [target_team]
     else:
         # Global Sync (or Guest Mode)
         if not authorized_slugs:
             # If guest or not in any teams, return empty data structure
-            return jsonify(success=True, data=[], deleted=[], teams=[], members=[], timestamp=datetime.utcnow().isoformat(), stats={"pending_requests": 0, "invite_code": None})
+            return jsonify(success=True, data=[], deleted=[], teams=[], members=[], timestamp=datetime.utcnow().isoformat(), cursor=current_sync_rev(), stats={"pending_requests": 0, "invite_code": None})
         
         # Filter patients by all authorized teams
         query = query.filter(Patient.team_id.in_(authorized_slugs))
+        synced_slugs = authorized_slugs
+
+    # Tombstones of the synced teams, plus global ones (disbanded teams, legacy
+    # rows) until they expire by age
+    tombstones = db.session.query(DeletedRecord.uid).filter(or_(DeletedRecord.team_id.in_(synced_slugs), DeletedRecord.team_id.is_(None)))
 
     # 3. DELTA SYNC LOGIC
-    if since_str:
+    cursor = None
+    if request.args.get('cursor'):
+        try:
+            cursor = int(request.args.get('cursor'))
+        except ValueError:
+            return jsonify(success=False, message="Invalid Cursor"), 400
+
+    # A delta request proves the client applied everything up to its cursor.
+    # Plain GETs are not acknowledged: many (dashboard counts, host push/pull)
+    # never replace the client's store.
+    # (Runs first: compaction must not race the reset check or expire loaded rows.)
+    if cursor is not None:
+        acknowledge_sync(requester_device, synced_slugs, cursor)
+
+    # Read the cursor before querying: anything committed after this point is
+    # either included now or (having a higher revision) on the next pull.
+    sync_cursor, compacted_rev = read_sync_counter()
+    reset = False
+    if cursor is not None and cursor < compacted_rev:
+        # Tombstones this client never saw were compacted: fall back to full sync
+        cursor, reset = None, True
+    is_delta = cursor is not None or digests is not None or bool(since_str and not reset)
+
+    if cursor is not None:
+        # One query: changed patients joined to their events
+        patients = query.filter(Patient.sync_rev > cursor).options(joinedload(Patient.events)).all()
+        deleted = [uid for (uid,) in tombstones.filter(DeletedRecord.sync_rev > cursor)]
+        teams = Team.query.filter(Team.slug.in_(authorized_slugs), Team.sync_rev > cursor).all()
+        members = TeamMember.query.filter(TeamMember.team_slug.in_(authorized_slugs), TeamMember.sync_rev > cursor).all()
+    elif digests is not None:
+        # Digest sync: compare stored digests (no events loaded), then fetch only
+        # the records that differ. Held uids that are no longer here come back
+        # as deletions, so the client ends up with exactly the full-sync set.
+        held = query.with_entities(Patient.id, Patient.uid, Patient.content_hash).all()
+        stale_ids = [row.id for row in held if digests.get(row.uid) != row.content_hash]
+        patients = []
+        for chunk in chunked(stale_ids):
+            patients.extend(query.filter(Patient.id.in_(chunk)).options(selectinload(Patient.events)).order_by(Patient.id))
+        present = {row.uid for row in held}
+        deleted = [uid for uid in digests if uid not in present]
+        teams = Team.query.filter(Team.slug.in_(authorized_slugs)).all()
+        members = TeamMember.query.filter(TeamMember.team_slug.in_(authorized_slugs)).all()
+    elif is_delta:
+        # Legacy timestamp delta (clients cached before the cursor existed)
         try:
             since_dt = datetime.fromisoformat(since_str)
-            p_direct = query.filter(Patient.updated_at > since_dt).all()
-            p_via_events = query.join(Event).filter(Event.updated_at > since_dt).all()
-            patients = list(set(p_direct + p_via_events))
-            
-            # Simple filtering for DeletedRecord (minor leak if not filtered by team, but manageable for now)
-            deleted = DeletedRecord.query.filter(DeletedRecord.timestamp > since_dt).all()
-            
-            teams = Team.query.filter(Team.slug.in_(authorized_slugs), Team.updated_at > since_dt).all()
-            members = TeamMember.query.filter(TeamMember.team_slug.in_(authorized_slugs), TeamMember.updated_at > since_dt).all()
-            
         except ValueError:
              return jsonify(success=False, message="Invalid Date Format"), 400
+
+        changed_via_events = db.select(Event.patient_id).where(Event.updated_at > since_dt)
+        patients = query.filter(or_(Patient.updated_at > since_dt, Patient.id.in_(changed_via_events)))\
+            .options(joinedload(Patient.events)).all()
+        deleted = [uid for (uid,) in tombstones.filter(DeletedRecord.timestamp > since_dt)]
+        teams = Team.query.filter(Team.slug.in_(authorized_slugs), Team.updated_at > since_dt).all()
+        members = TeamMember.query.filter(TeamMember.team_slug.in_(authorized_slugs), TeamMember.updated_at > since_dt).all()
     else:
-        # Full Sync
-        patients = query.all()
-        deleted = DeletedRecord.query.all() # Minor leak: all deleted UIDs. Acceptable trade-off for simplicity vs adding field.
+        # Full Sync (events loaded per batch with one IN query, not per patient)
+        patients = query.options(selectinload(Patient.events)).order_by(Patient.id)
+        deleted = [uid for (uid,) in tombstones]
         teams = Team.query.filter(Team.slug.in_(authorized_slugs)).all()
         members = TeamMember.query.filter(TeamMember.team_slug.in_(authorized_slugs)).all()
+
+    stats = {"pending_requests": pending_count, "invite_code": invite_code}
+
+    # 4a. Streaming mode (?format=ndjson): one JSON object per line, patients
+    # read from a server-side cursor in batches so memory stays flat
+    if request.args.get('format') == 'ndjson':
+        if not is_delta: patients = patients.yield_per(SYNC_STREAM_BATCH)
+        return stream_sync_ndjson(patients, deleted, teams, members, stats, sync_cursor, reset)
+
+    # 4b. Serialize
+    data = [serialize_patient(p) for p in patients]
+    teams_data = [serialize_team(t) for t in teams]
+    members_data = [serialize_member(m) for m in members]
     
-    data = []
-    
-    # 4. Serialize
-    for p in patients:
-        p_data = {
-            "uid": p.uid,
-            "team_id": p.team_id,
-            "updated_at": p.updated_at.isoformat() if p.updated_at else None,
-            "name": p.name, "age": p.age, "sex": p.sex, 
-            "address": p.address, "regime": p.regime, "remark": p.remark,
-            "events": []
-        }
-        for e in p.events:
-            p_data["events"].append({
-                "id": e.id,
-                "updated_at": e.updated_at.isoformat() if e.updated_at else None,
-                "title": e.title, "start": e.start, "original_start": e.original_start,
-                "color": e.color, "missed_days": e.missed_days, 
-                "remark": e.remark, "outcome": e.outcome
-            })
-        data.append(p_data)
-        
-    deleted_uids = [d.uid for d in deleted]
-    
-    teams_data = [
-        {"slug": t.slug, "name": t.name, "created_at": t.created_at.isoformat() if t.created_at else None}
-        for t in teams
+    return jsonify(success=True, data=data, deleted=deleted, teams=teams_data, members=members_data, timestamp=datetime.utcnow().isoformat(), cursor=sync_cursor, reset=reset, stats=stats)
+
+# ---- BULK MERGE ----
+# Merging a peer's payload used to cost several queries per record. The engine
+# below pre-fetches every lookup with one IN query per chunk, builds the rows in
+# memory and writes them with executemany, all inside the caller's transaction.
+# Core statements bypass the before_flush stamp, so rows carry the revision
+# taken up front explicitly.
+
+def delete_patients(patient_ids):
+    # Core deletes skip the ORM cascade, so events go explicitly first
+    event_t, patient_t = Event.__table__, Patient.__table__
+    for chunk in chunked(patient_ids):
+        db.session.execute(event_t.delete().where(event_t.c.patient_id.in_(chunk)))
+        db.session.execute(patient_t.delete().where(patient_t.c.id.in_(chunk)))
+
+def insert_patients(patients_in, rev):
+    # patients_in: payload dicts whose "uid" is already resolved
+    if not patients_in: return
+    db.session.execute(Patient.__table__.insert(), [{
+        "uid": p_in["uid"],
+        # If team_id missing in older payloads, default to DEFAULT
+        "team_id": p_in.get("team_id", "DEFAULT"),
+        "name": p_in["name"], "age": p_in["age"], "sex": p_in["sex"],
+        "address": p_in["address"], "regime": p_in["regime"], "remark": p_in["remark"],
+        "sync_rev": rev
+    } for p_in in patients_in])
+
+    id_by_uid = dict(select_in(db.select(Patient.uid, Patient.id), Patient.uid, [p_in["uid"] for p_in in patients_in]))
+    insert_events(patients_in, id_by_uid)
+
+def insert_events(patients_in, id_by_uid):
+    mark_content_changed(db.session, id_by_uid.values())
+    event_rows = [{
+        "title": e_in["title"], "start": e_in["start"], "original_start": e_in["original_start"],
+        "color": e_in["color"], "missed_days": e_in["missed_days"],
+        "remark": e_in["remark"], "outcome": e_in["outcome"],
+        "patient_id": id_by_uid[p_in["uid"]]
+    } for p_in in patients_in for e_in in p_in["events"]]
+    if event_rows:
+        db.session.execute(Event.__table__.insert(), event_rows)
+
+def update_patients(patients_in, rev):
+    # patients_in: payload dicts carrying the "id" of the row they overwrite.
+    # Fields are updated in one executemany, events replaced wholesale.
+    if not patients_in: return
+    patient_t, event_t = Patient.__table__, Event.__table__
+    db.session.execute(
+        patient_t.update().where(patient_t.c.id == db.bindparam("p_id")).values(
+            team_id=db.func.coalesce(db.bindparam("p_team"), patient_t.c.team_id),
+            name=db.bindparam("p_name"), age=db.bindparam("p_age"), sex=db.bindparam("p_sex"), address=db.bindparam("p_address"),
+            regime=db.bindparam("p_regime"), remark=db.bindparam("p_remark"), sync_rev=rev
+        ),
+        [{
+            "p_id": p_in["id"], "p_team": p_in.get("team_id"), "p_name": p_in["name"], "p_age": p_in["age"], "p_sex": p_in["sex"],
+            "p_address": p_in["address"], "p_regime": p_in["regime"], "p_remark": p_in["remark"]
+        } for p_in in patients_in]
+    )
+    for chunk in chunked([p_in["id"] for p_in in patients_in]):
+        db.session.execute(event_t.delete().where(event_t.c.patient_id.in_(chunk)))
+    insert_events(patients_in, {p_in["uid"]: p_in["id"] for p_in in patients_in})
+
+def changed_patients(patients_in):
+    # Split a payload against stored digests: ({uid: row} of known patients,
+    # payloads whose content differs from the stored row). Events stay unloaded.
+    known = {
+        row.uid: row for row in select_in(db.select(Patient.id, Patient.uid, Patient.content_hash), Patient.uid,
+                                          [p_in["uid"] for p_in in patients_in if p_in.get("uid")])
+    }
+    changed = [
+        {**p_in, "id": known[p_in["uid"]].id} for p_in in patients_in
+        if p_in.get("uid") in known and known[p_in["uid"]].content_hash != content_digest(p_in, p_in.get("events", []))
     ]
-    
-    members_data = [
-        {
-            "team_slug": m.team_slug, "user_name": m.user_name, 
-            "device_id": m.device_id, "status": m.status,
-            "updated_at": m.updated_at.isoformat() if m.updated_at else None
-        }
-        for m in members
+    return known, changed
+
+def replace_team_patients(incoming_patients, incoming_teams, rev):
+    # Replace is scoped to the teams present in the payload: their patients (and
+    # any incoming uid living elsewhere) are deleted here, then re-inserted by
+    # the caller in the same transaction. Other teams are never touched.
+    scope = {p_in.get("team_id", "DEFAULT") for p_in in incoming_patients}
+    scope.update(t_in["slug"] for t_in in incoming_teams)
+    in_uids = {p_in["uid"] for p_in in incoming_patients if p_in.get("uid")}
+
+    doomed = {row.id: row for row in select_in(db.select(Patient.id, Patient.uid, Patient.team_id), Patient.team_id, scope)}
+    doomed.update({row.id: row for row in select_in(db.select(Patient.id, Patient.uid, Patient.team_id), Patient.uid, in_uids)})
+    delete_patients(list(doomed))
+
+    # Patients that are gone for good need tombstones so peers drop them too
+    gone = {row.uid: row.team_id for row in doomed.values() if row.uid and row.uid not in in_uids}
+    known_tombs = {uid for (uid,) in select_in(db.select(DeletedRecord.uid), DeletedRecord.uid, gone)}
+    new_tombs = [{"uid": uid, "team_id": team_id, "sync_rev": rev} for uid, team_id in gone.items() if uid not in known_tombs]
+    if new_tombs:
+        db.session.execute(DeletedRecord.__table__.insert(), new_tombs)
+
+def bulk_merge(incoming_patients, incoming_deleted, incoming_teams, incoming_members, mode="append", rev=None):
+    if rev is None: rev = next_sync_rev(db.session)
+    skip_existing = mode in ("append", "update")
+    team_t, member_t = Team.__table__, TeamMember.__table__
+
+    # 1. Process Deletions First
+    deleted_team_slugs = {d_uid.split(":", 1)[1] for d_uid in incoming_deleted if d_uid.startswith("team:")}
+    deleted_patient_uids = [d_uid for d_uid in incoming_deleted if not d_uid.startswith("team:")]
+
+    # Team Delete: cascade everything for teams that exist here
+    live_teams = [slug for (slug,) in select_in(db.select(Team.slug), Team.slug, deleted_team_slugs)]
+    if live_teams:
+        delete_patients([pid for (pid,) in select_in(db.select(Patient.id), Patient.team_id, live_teams)])
+        for chunk in chunked(live_teams):
+            db.session.execute(member_t.delete().where(member_t.c.team_slug.in_(chunk)))
+            db.session.execute(team_t.delete().where(team_t.c.slug.in_(chunk)))
+        for slug in live_teams: print(f"Synced Deletion of Team: {slug}")
+
+    # Patient Delete
+    live_patients = select_in(db.select(Patient.uid, Patient.id, Patient.team_id), Patient.uid, deleted_patient_uids)
+    delete_patients([row.id for row in live_patients])
+
+    # Ensure tombstones exist locally too (to propagate further)
+    # Team tombstones (and patients of a deleted team) stay global (team_id NULL):
+    # nobody is a member of a deleted team, so team-scoped ones would never be served
+    tomb_team = {row.uid: row.team_id for row in live_patients}
+    known_tombs = {uid for (uid,) in select_in(db.select(DeletedRecord.uid), DeletedRecord.uid, incoming_deleted)}
+    new_tombs = [
+        {"uid": d_uid, "team_id": tomb_team.get(d_uid), "sync_rev": rev}
+        for d_uid in dict.fromkeys(incoming_deleted) if d_uid not in known_tombs
     ]
-    
-    return jsonify(success=True, data=data, deleted=deleted_uids, teams=teams_data, members=members_data, timestamp=datetime.utcnow().isoformat(), stats={"pending_requests": pending_count, "invite_code": invite_code})
+    if new_tombs:
+        db.session.execute(DeletedRecord.__table__.insert(), new_tombs)
+
+    if mode == "replace":
+        replace_team_patients(incoming_patients, incoming_teams, rev)
+
+    # 'update' also overwrites known uids, but only those whose digest differs
+    updated = 0
+    if mode == "update":
+        known, changed = changed_patients(incoming_patients)
+        update_patients(changed, rev)
+        updated = len(changed)
+        incoming_patients = [p_in for p_in in incoming_patients if p_in.get("uid") not in known]
+
+    # 2. Process Adds (Patients). Append mode skips anything already known by uid or name.
+    taken_uids, taken_names = set(), set()
+    if skip_existing:
+        in_uids = [p_in["uid"] for p_in in incoming_patients if p_in.get("uid")]
+        taken_uids = {uid for (uid,) in select_in(db.select(Patient.uid), Patient.uid, in_uids)}
+        taken_names = {name for (name,) in select_in(db.select(Patient.name), Patient.name, [p_in["name"] for p_in in incoming_patients])}
+
+    to_insert = []
+    for p_in in incoming_patients:
+        in_uid = p_in.get("uid")
+        if skip_existing and ((in_uid and in_uid in taken_uids) or p_in["name"] in taken_names):
+            continue
+        uid = in_uid if in_uid else str(uuid.uuid4())
+        to_insert.append({**p_in, "uid": uid})
+        taken_uids.add(uid)
+        taken_names.add(p_in["name"])
+    insert_patients(to_insert, rev)
+
+    # 3. Process Teams (Append Only - Safe, as slugs are unique)
+    known_slugs = {slug for (slug,) in select_in(db.select(Team.slug), Team.slug, [t_in["slug"] for t_in in incoming_teams])}
+    new_teams = []
+    for t_in in incoming_teams:
+        if t_in["slug"] in known_slugs: continue
+        known_slugs.add(t_in["slug"])
+        new_teams.append({"name": t_in["name"], "slug": t_in["slug"], "sync_rev": rev})
+    if new_teams:
+        db.session.execute(team_t.insert(), new_teams)
+
+    # 4. Process Members (update status if changed, e.g. APPROVED on host)
+    devices = {m_in["device_id"] for m_in in incoming_members}
+    existing_mem = {
+        (row.team_slug, row.device_id): row
+        for row in select_in(db.select(TeamMember.id, TeamMember.team_slug, TeamMember.device_id, TeamMember.status),
+                             TeamMember.team_slug, [m_in["team_slug"] for m_in in incoming_members])
+        if row.device_id in devices
+    }
+    status_updates, new_members = {}, {}
+    for m_in in incoming_members:
+        key = (m_in["team_slug"], m_in["device_id"])
+        if key in new_members:
+            new_members[key]["status"] = m_in["status"]
+        elif key in existing_mem:
+            if existing_mem[key].status != m_in["status"] or key in status_updates:
+                status_updates[key] = {"m_id": existing_mem[key].id, "m_status": m_in["status"]}
+        else:
+            new_members[key] = {
+                "team_slug": m_in["team_slug"], "user_name": m_in["user_name"],
+                "device_id": m_in["device_id"], "status": m_in["status"], "sync_rev": rev
+            }
+    if status_updates:
+        db.session.execute(
+            member_t.update().where(member_t.c.id == db.bindparam("m_id"))
+            .values(status=db.bindparam("m_status"), sync_rev=rev),
+            list(status_updates.values())
+        )
+    if new_members:
+        db.session.execute(member_t.insert(), list(new_members.values()))
+    if live_teams or status_updates or new_members:
+        bump_members_rev(db.session)
+
+    return len(to_insert) + updated
 
 # 2. Merge Data (Guest pulls from Host -> Appends/Replaces Local)
 @app.route("/api/merge_data", methods=["POST"])
 def merge_data():
     try:
         req = request.json
-        mode = req.get("mode", "append") # 'append' or 'replace'
+        mode = req.get("mode", "append") # 'append', 'update' (append + overwrite changed uids) or 'replace'
         incoming_patients = req.get("data", [])
         incoming_deleted = req.get("deleted", []) # New
 
         incoming_teams = req.get("teams", [])
         incoming_members = req.get("members", [])
 
-        if mode == "replace":
-            db.drop_all()
-            db.create_all()
-        
-        # 1. Process Deletions First
-        for d_uid in incoming_deleted:
-            # Check for Team Deletion (prefix "team:")
-            if d_uid.startswith("team:"):
-                # Handle Team Delete
-                t_slug = d_uid.split(":", 1)[1]
-                t_rec = Team.query.filter_by(slug=t_slug).first()
-                if t_rec: 
-                    # Cascade delete everything for this team
-                    sub_p = Patient.query.filter_by(team_id=t_slug).all()
-                    for sp in sub_p:
-                        Event.query.filter_by(patient_id=sp.id).delete()
-                        db.session.delete(sp)
-                        # We don't necessarily need tombstones for these sub-patients 
-                        # if the peer also gets the 'team:' tombstone. 
-                        # But adding them doesn't hurt.
-                    
-                    TeamMember.query.filter_by(team_slug=t_slug).delete()
-                    db.session.delete(t_rec)
-                    print(f"Synced Deletion of Team: {t_slug}")
-            else:
-                # Handle Patient Delete
-                p = Patient.query.filter_by(uid=d_uid).first()
-                if p:
-                    db.session.delete(p)
-                    
-            # Ensure tombstone exists locally too (to propagate further)
-            if not DeletedRecord.query.filter_by(uid=d_uid).first():
-                db.session.add(DeletedRecord(uid=d_uid))
-        
-        # 2. Process Adds/Updates (Patients)
-        count = 0
-        for p_in in incoming_patients:
-            in_uid = p_in.get("uid")
-            if mode == "append":
-                exists = None
-                if in_uid: exists = Patient.query.filter_by(uid=in_uid).first()
-                if not exists: exists = Patient.query.filter_by(name=p_in["name"]).first()
-                if exists: continue 
-
-            new_p = Patient(
-                uid=in_uid if in_uid else str(uuid.uuid4()),
-                # If team_id missing in older payloads, default to DEFAULT
-                team_id=p_in.get("team_id", "DEFAULT"), 
-                name=p_in["name"], age=p_in["age"], sex=p_in["sex"],
-                address=p_in["address"], regime=p_in["regime"], remark=p_in["remark"]
-            )
-            db.session.add(new_p)
-            db.session.flush()
-
-            for e_in in p_in["events"]:
-                new_e = Event(
-                    title=e_in["title"], start=e_in["start"], original_start=e_in["original_start"],
-                    color=e_in["color"], missed_days=e_in["missed_days"],
-                    remark=e_in["remark"], outcome=e_in["outcome"],
-                    patient_id=new_p.id
-                )
-                db.session.add(new_e)
-            count += 1
-            
-        # 3. Process Teams (Append Only - Safe, as slugs are unique)
-        for t_in in incoming_teams:
-            if not Team.query.filter_by(slug=t_in["slug"]).first():
-                db.session.add(Team(name=t_in["name"], slug=t_in["slug"]))
-                
-        # 4. Process Members
-        for m_in in incoming_members:
-            # Check if membership exists
-            existing_mem = TeamMember.query.filter_by(
-                team_slug=m_in["team_slug"], 
-                device_id=m_in["device_id"]
-            ).first()
-            
-            if existing_mem:
-                # Update status if changed (e.g. APPROVED on host)
-                existing_mem.status = m_in["status"]
-            else:
-                db.session.add(TeamMember(
-                    team_slug=m_in["team_slug"],
-                    user_name=m_in["user_name"],
-                    device_id=m_in["device_id"],
-                    status=m_in["status"]
-                ))
+        # 'replace' swaps only the payload's teams, inside this one transaction
+        count = bulk_merge(incoming_patients, incoming_deleted, incoming_teams, incoming_members, mode=mode)
         
         db.session.commit()
+        invalidate_directory()
         return jsonify(success=True, count=count)
     except Exception as e:
+        db.session.rollback()
         return jsonify(success=False, message=str(e)), 500
 
 # 3. Stage Incoming (Guest pushes to Host -> Host reviews)
-DEVICE_STAGING = {} # { "DeviceName": { "data": [], "deleted": [], "timestamp": ... } }
-CONNECTED_DEVICES = {} 
+# Each push replaces the device's pending items. Pushes over the quota are refused
+# and anything left unreviewed past the TTL is dropped.
+STAGING_MAX_BYTES = int(os.environ.get("STAGING_MAX_BYTES", 20 * 1024 * 1024)) # per device
+STAGING_MAX_ITEMS = int(os.environ.get("STAGING_MAX_ITEMS", 20000)) # per device
+STAGING_TTL_HOURS = int(os.environ.get("STAGING_TTL_HOURS", 72))
+
+def staging_cutoff():
+    return datetime.utcnow() - timedelta(hours=STAGING_TTL_HOURS)
+
+def evict_stale_staging():
+    # Eviction only runs on push; readers filter on staging_cutoff() so expired
+    # items are never offered for review even if no device has pushed since
+    cutoff = staging_cutoff()
+    StagedItem.query.filter(StagedItem.created_at < cutoff).delete(synchronize_session=False)
+    StagedDevice.query.filter(StagedDevice.last_seen < cutoff).delete(synchronize_session=False)
+
+def load_staging(device_names=None):
+    # { device: {"data": [(item_id, dict)], "deleted": [(item_id, uid)], "teams": [...], "members": [...]} }
+    q = db.session.query(StagedItem.id, StagedItem.device_name, StagedItem.kind, StagedItem.uid, StagedItem.payload)\
+        .filter(StagedItem.created_at >= staging_cutoff())
+    if device_names is not None: q = q.filter(StagedItem.device_name.in_(list(device_names)))
+    stages = {}
+    for item_id, d_name, kind, uid, payload in q.order_by(StagedItem.id):
+        stage = stages.setdefault(d_name, {"data": [], "deleted": [], "teams": [], "members": []})
+        if kind == "record": stage["data"].append((item_id, json.loads(payload)))
+        elif kind == "deletion": stage["deleted"].append((item_id, uid))
+        elif kind == "team": stage["teams"].append((item_id, json.loads(payload)))
+        elif kind == "member": stage["members"].append((item_id, json.loads(payload)))
+    return stages
 
 @app.route("/api/stage_incoming", methods=["POST"])
 def stage_incoming():
-    global DEVICE_STAGING, CONNECTED_DEVICES
     try:
         data = request.json
+        device_name = (data.get("device_name") or "Unknown Guest")[:100]
+
+        # 1. Records identical to ours (same digest) need no review: drop them
         incoming_data = data.get("data", [])
-        incoming_deleted = data.get("deleted", [])
-        incoming_teams = data.get("teams", [])
-        incoming_members = data.get("members", [])
-        
-        device_name = data.get("device_name", "Unknown Guest")
-        
-        # Update Stats
-        client_ip = request.remote_addr
-        if device_name not in CONNECTED_DEVICES:
-            CONNECTED_DEVICES[device_name] = { "ip": client_ip, "pushes": 0, "last_seen": None }
-        
-        CONNECTED_DEVICES[device_name]["pushes"] += 1
-        CONNECTED_DEVICES[device_name]["last_seen"] = datetime.now().strftime("%H:%M:%S")
-        
-        # Store Data Per Device
-        DEVICE_STAGING[device_name] = {
-            "data": incoming_data,
-            "deleted": incoming_deleted,
-            "teams": incoming_teams,
-            "members": incoming_members,
-            "timestamp": datetime.now()
-        }
-        
-        return jsonify(success=True, count=len(incoming_data) + len(incoming_deleted))
+        known, changed = changed_patients(incoming_data)
+        changed_uids = {p_in["uid"] for p_in in changed}
+        incoming_data = [p for p in incoming_data if p.get("uid") not in known or p["uid"] in changed_uids]
+
+        # 2. Serialise once; the sizes drive the quota
+        rows = []
+        for p in incoming_data:
+            rows.append({"kind": "record", "uid": p.get("uid"), "payload": json.dumps(p)})
+        for d_uid in data.get("deleted", []):
+            rows.append({"kind": "deletion", "uid": d_uid, "payload": None})
+        for t in data.get("teams", []):
+            rows.append({"kind": "team", "uid": None, "payload": json.dumps(t)})
+        for m in data.get("members", []):
+            rows.append({"kind": "member", "uid": None, "payload": json.dumps(m)})
+
+        size = sum(len(r["payload"] or r["uid"] or "") for r in rows)
+        if len(rows) > STAGING_MAX_ITEMS or size > STAGING_MAX_BYTES:
+            return jsonify(success=False, message=f"Push too large ({len(rows)} items, {size} bytes); sync in smaller batches"), 413
+
+        # 3. Swap this device's pending items in one transaction
+        evict_stale_staging()
+        StagedItem.query.filter_by(device_name=device_name).delete(synchronize_session=False)
+        now = datetime.utcnow()
+        for batch in chunked(rows):
+            db.session.execute(StagedItem.__table__.insert(), [{**r, "device_name": device_name, "created_at": now} for r in batch])
+
+        # 4. Update Stats
+        device = db.session.get(StagedDevice, device_name)
+        if not device:
+            device = StagedDevice(device_name=device_name, pushes=0)
+            db.session.add(device)
+        device.ip = request.remote_addr
+        device.pushes = (device.pushes or 0) + 1
+        device.size_bytes = size
+        device.last_seen = now
+
+        db.session.commit()
+        return jsonify(success=True, count=len(incoming_data) + len(data.get("deleted", [])), unchanged=len(data.get("data", [])) - len(incoming_data))
     except Exception as e:
+        db.session.rollback()
         return jsonify(success=False, message=str(e)), 500
 
 @app.route("/api/get_host_info")
 def get_host_info():
     hostname = socket.gethostname()
+    cutoff = staging_cutoff()
+    pending = dict(
+        db.session.query(StagedItem.device_name, db.func.count(StagedItem.id))
+        .filter(StagedItem.created_at >= cutoff)
+        .group_by(StagedItem.device_name).all()
+    )
     devices_list = []
-    for name, info in CONNECTED_DEVICES.items():
-        # Check if pending data exists
-        has_pending = name in DEVICE_STAGING and (
-            len(DEVICE_STAGING[name]["data"]) > 0 or 
-            len(DEVICE_STAGING[name]["deleted"]) > 0 or
-            len(DEVICE_STAGING[name].get("teams", [])) > 0 or
-            len(DEVICE_STAGING[name].get("members", [])) > 0
-        )
-        
+    for d in StagedDevice.query.filter(StagedDevice.last_seen >= cutoff).order_by(StagedDevice.last_seen.desc()).all():
         devices_list.append({
-            "name": name,
-            "ip": info["ip"],
-            "pushes": info["pushes"],
-            "last_seen": info["last_seen"],
-            "has_pending": has_pending
+            "name": d.device_name,
+            "ip": d.ip,
+            "pushes": d.pushes,
+            "last_seen": d.last_seen.replace(tzinfo=timezone.utc).astimezone().strftime("%H:%M:%S") if d.last_seen else None,
+            "has_pending": pending.get(d.device_name, 0) > 0
         })
-        
+
     return jsonify({
         "hostname": hostname,
         "devices": devices_list
     })
 
+def match_staged_patients(records, deleted_uids=()):
+    # Existing patients a staged push refers to, matched by uid or else by name
+    # (older guests). One bulk pass: {uid: row}, {name: row}
+    cols = db.select(Patient.id, Patient.uid, Patient.name, Patient.team_id, Patient.content_hash)
+    uids = {p["uid"] for p in records if p.get("uid")} | set(deleted_uids)
+    by_uid = {row.uid: row for row in select_in(cols, Patient.uid, uids)}
+    names = {p["name"] for p in records if p.get("uid") not in by_uid}
+    by_name = {}
+    for row in select_in(cols.order_by(Patient.id), Patient.name, names):
+        by_name.setdefault(row.name, row) # first match, as .first() did
+    return by_uid, by_name
+
+def find_staged_patient(p, by_uid, by_name):
+    return by_uid.get(p.get("uid")) or by_name.get(p["name"])
+
 @app.route("/api/get_staged_data")
 def get_staged_data():
     target_device = request.args.get("device")
     
+    # Aggregate ALL if 'all' or no device specified
+    stages = load_staging([target_device] if target_device and target_device != "all" else None)
+    by_uid, by_name = match_staged_patients(
+        [p for stage in stages.values() for _, p in stage["data"]],
+        [d_uid for stage in stages.values() for _, d_uid in stage["deleted"]]
+    )
+
     # helper
     def process_device_stage(d_name, stage_obj):
         d_items = []
@@ -620,36 +1528,18 @@ def get_staged_data():
         raw_del = stage_obj.get("deleted", [])
         raw_teams = stage_obj.get("teams", [])
         
-        # Records
-        for i, p in enumerate(raw_data):
+        # Records (idx is the staged item id, echoed back by commit_staged)
+        for i, p in raw_data:
             status = "NEW"
-            existing = None
-            if p.get("uid"): existing = Patient.query.filter_by(uid=p.get("uid")).first()
-            if not existing: existing = Patient.query.filter_by(name=p["name"]).first()
-            
+            existing = find_staged_patient(p, by_uid, by_name)
             if existing:
-                 is_diff = False
-                 if existing.name != p["name"]: is_diff = True
-                 if existing.age != p["age"]: is_diff = True
-                 if existing.sex != p["sex"]: is_diff = True
-                 if existing.address != p["address"]: is_diff = True
-                 if existing.regime != p["regime"]: is_diff = True
-                 if existing.remark != p["remark"]: is_diff = True
-                 if len(existing.events) != len(p["events"]): is_diff = True
-                 else:
-                     ex_evs = sorted(existing.events, key=lambda x: x.original_start)
-                     in_evs = sorted(p["events"], key=lambda x: x["original_start"])
-                     for i_ev in range(len(ex_evs)):
-                         e1 = ex_evs[i_ev]; e2 = in_evs[i_ev]
-                         if (e1.missed_days != e2["missed_days"] or e1.outcome != e2["outcome"] or e1.start != e2["start"]):
-                             is_diff = True; break
-                 status = "UPDATE" if is_diff else "SAME"
+                status = "SAME" if existing.content_hash == content_digest(p, p.get("events", [])) else "UPDATE"
 
             d_items.append({**p, "status": status, "type": "record", "source_device": d_name, "idx": i})
 
         # Deletions
-        for i, del_uid in enumerate(raw_del):
-            p_active = Patient.query.filter_by(uid=del_uid).first()
+        for i, del_uid in raw_del:
+            p_active = by_uid.get(del_uid)
             if p_active:
                 d_items.append({
                     "uid": del_uid,
@@ -674,19 +1564,13 @@ def get_staged_data():
         return d_items
 
     enriched = []
-    
-    if target_device and target_device in DEVICE_STAGING and target_device != "all":
-        enriched = process_device_stage(target_device, DEVICE_STAGING[target_device])
-    else:
-        # Aggregate ALL if 'all' or no device specified
-        for d_name, stage_obj in DEVICE_STAGING.items():
-            enriched.extend(process_device_stage(d_name, stage_obj))
+    for d_name, stage_obj in stages.items():
+        enriched.extend(process_device_stage(d_name, stage_obj))
     
     return jsonify(success=True, data=enriched)
 
 @app.route("/api/commit_staged", methods=["POST"])
 def commit_staged():
-    global DEVICE_STAGING
     try:
         req = request.json
         commits_map = req.get("commits_by_device")
@@ -698,119 +1582,50 @@ def commit_staged():
             if target: commits_map = {target: idxs}
             else: return jsonify(success=False, message="No data provided"), 400
 
-        total_merged = 0
-        
-        for d_name, indices in commits_map.items():
-            if d_name not in DEVICE_STAGING: continue
-            
-            stage = DEVICE_STAGING[d_name]
-            # Retrieve validation arrays
-            current_data = stage.get("data", [])
-            current_deleted = stage.get("deleted", [])
-            
-            # --- AUTO MERGE TEAMS & MEMBERS ---
-            current_teams = stage.get("teams", [])
-            current_members = stage.get("members", [])
-            
-            for t_in in current_teams:
-                if not Team.query.filter_by(slug=t_in["slug"]).first():
-                    db.session.add(Team(name=t_in["name"], slug=t_in["slug"]))
-            
-            for m_in in current_members:
-                 existing_mem = TeamMember.query.filter_by(team_slug=m_in["team_slug"], device_id=m_in["device_id"]).first()
-                 if existing_mem:
-                     existing_mem.status = m_in["status"]
-                 else:
-                     db.session.add(TeamMember(
-                        team_slug=m_in["team_slug"],
-                        user_name=m_in["user_name"],
-                        device_id=m_in["device_id"],
-                        status=m_in["status"]
-                    ))
-            
-            # Clear them after merge to avoid re-merging
-            stage["teams"] = []
-            stage["members"] = []
-            
-            # --- END AUTO MERGE ---
-            
-            num_data = len(current_data)
-            
-            # Identify what to commit based on indices
-            # Indices: 0..N-1 (records), N..M (deletions)
-            indices = set([int(x) for x in indices])
-            
-            data_indices_to_commit = []
-            del_indices_to_commit = []
-            
-            for i in indices:
-                if i < num_data:
-                    data_indices_to_commit.append(i)
-                else:
-                    del_indices_to_commit.append(i - num_data)
-            
-            # Application Logic: Records
-            for i in data_indices_to_commit:
-                if i >= len(current_data): continue
-                p_in = current_data[i]
-                
-                exists = None
-                if p_in.get("uid"): exists = Patient.query.filter_by(uid=p_in.get("uid")).first()
-                if not exists: exists = Patient.query.filter_by(name=p_in["name"]).first()
-                
-                if exists:
-                    exists.age = p_in["age"]
-                    exists.sex = p_in["sex"]
-                    exists.address = p_in["address"]
-                    exists.regime = p_in["regime"]
-                    exists.remark = p_in["remark"]
-                    
-                    # Update team_id if provided
-                    if "team_id" in p_in: exists.team_id = p_in["team_id"]
-                        
-                    Event.query.filter_by(patient_id=exists.id).delete()
-                else:
-                    exists = Patient(
-                        uid=p_in.get("uid") or str(uuid.uuid4()),
-                        name=p_in["name"], age=p_in["age"], sex=p_in["sex"],
-                        address=p_in["address"], regime=p_in["regime"], remark=p_in["remark"],
-                        team_id=p_in.get("team_id", "DEFAULT")
-                    )
-                    db.session.add(exists)
-                    db.session.flush()
-
-                for e_in in p_in["events"]:
-                    db.session.add(Event(
-                        title=e_in["title"], start=e_in["start"], original_start=e_in["original_start"],
-                        color=e_in["color"], missed_days=e_in["missed_days"],
-                        remark=e_in["remark"], outcome=e_in["outcome"],
-                        patient_id=exists.id
-                    ))
-                total_merged += 1
-
-            # Application Logic: Deletions
-            for i in del_indices_to_commit:
-                if i >= len(current_deleted): continue
-                d_uid = current_deleted[i]
-                p = Patient.query.filter_by(uid=d_uid).first()
-                if p: db.session.delete(p)
-                if not DeletedRecord.query.filter_by(uid=d_uid).first():
-                    db.session.add(DeletedRecord(uid=d_uid))
-                total_merged += 1
-            
-            db.session.commit()
+        # 1. Every selected device's items in one query. Selections are staged
+        # item ids; teams & members of those devices always auto-merge.
+        selected = {int(i) for indices in commits_map.values() for i in indices}
+        records, deletions, teams, members, done_ids = [], [], [], [], []
+        for d_name, stage in load_staging(commits_map.keys()).items():
+            records += [p_in for i, p_in in stage["data"] if i in selected]
+            deletions += [d_uid for i, d_uid in stage["deleted"] if i in selected]
+            teams += [t_in for _, t_in in stage["teams"]]
+            members += [m_in for _, m_in in stage["members"]]
+            done_ids += [i for i, _ in stage["teams"] + stage["members"]]
+            done_ids += [i for i, _ in stage["data"] + stage["deleted"] if i in selected]
+
+        # 2. Records: match by uid, else by name (one bulk lookup). Matches are
+        # overwritten in place; a later device's copy of the same record wins.
+        by_uid, by_name = match_staged_patients(records)
+        updates, inserts, new_uid_by_name = {}, {}, {}
+        for p_in in records:
+            existing = find_staged_patient(p_in, by_uid, by_name)
+            if existing:
+                updates[existing.id] = {**p_in, "uid": existing.uid, "id": existing.id}
+            else:
+                uid = p_in.get("uid") or new_uid_by_name.get(p_in["name"]) or str(uuid.uuid4())
+                new_uid_by_name.setdefault(p_in["name"], uid)
+                inserts[uid] = {**p_in, "uid": uid}
 
-            # Cleanup Staged Data (Remove committed items)
-            # Iterate in reverse to avoid index shifting
-            for i in sorted(data_indices_to_commit, reverse=True):
-                if i < len(current_data): current_data.pop(i)
-            
-            for i in sorted(del_indices_to_commit, reverse=True):
-                if i < len(current_deleted): current_deleted.pop(i)
-            
-            return jsonify(success=True, message=f"Merged {total_merged} items.")
+        rev = next_sync_rev(db.session)
+        update_patients(list(updates.values()), rev)
+        insert_patients(list(inserts.values()), rev)
+
+        # 3. Deletions, teams and members through the bulk merge engine
+        bulk_merge([], deletions, teams, members, rev=rev)
+
+        # 4. Drop the committed items; everything lands in one transaction
+        for batch in chunked(done_ids):
+            StagedItem.query.filter(StagedItem.id.in_(batch)).delete(synchronize_session=False)
+
+        db.session.commit()
+        invalidate_directory()
+
+        total_merged = len(records) + len(deletions)
+        return jsonify(success=True, count=total_merged, message=f"Merged {total_merged} items.")
 
     except Exception as e:
+        db.session.rollback()
         print("Error committing staged:", e)
         return jsonify(success=False, message=str(e)), 500
 
@@ -863,6 +1678,7 @@ def create_team():
     db.session.add(member)
     
     db.session.commit()
+    if is_public: invalidate_directory()
     return jsonify(success=True, team_slug=slug, invite_code=code)
 
 @app.route("/api/teams/lookup", methods=["GET"])
@@ -927,6 +1743,7 @@ def join_team():
     new_mem = TeamMember(team_slug=slug, user_name=user_name, device_id=device_id, status=initial_status)
     db.session.add(new_mem)
     db.session.commit()
+    invalidate_directory(slug, member_delta=1)
     
     msg = "Joined Team instantly!" if team.is_public else "Requested join. Awaiting approval."
     return jsonify(success=True, status=initial_status, message=msg, team_slug=slug, team_name=team.name)
@@ -944,12 +1761,12 @@ def list_teams():
     created_count = 0
     joined_count = 0
     if requester_device:
-        memberships = TeamMember.query.filter_by(device_id=requester_device).all()
+        memberships = get_device_memberships(requester_device)
         # Map slug -> status (e.g. 'ph-clinic': 'APPROVED')
-        my_teams_status = {m.team_slug: m.status for m in memberships}
+        my_teams_status = {slug: status for slug, status, _ in memberships}
         
-        # Quota counts
-        created_count = TeamMember.query.filter_by(device_id=requester_device, role='ADMIN').count()
+        # Quota counts (from the same cached rows, no extra COUNT)
+        created_count = sum(1 for _, _, role in memberships if role == 'ADMIN')
         joined_count = len(memberships)
 
     if tab == 'my-team':
@@ -958,9 +1775,13 @@ def list_teams():
         if not my_teams_status:
              return jsonify(success=True, teams=[], total_pages=1, current_page=1)
              
-        teams = Team.query.filter(Team.slug.in_(my_teams_status.keys())).all()
+        # One grouped query: my teams with their member counts
+        teams = db.session.query(Team, db.func.count(TeamMember.id))\
+            .outerjoin(TeamMember, Team.slug == TeamMember.team_slug)\
+            .filter(Team.slug.in_(my_teams_status.keys()))\
+            .group_by(Team.id).all()
         result_teams = []
-        for t in teams:
+        for t, m_count in teams:
             status = my_teams_status.get(t.slug)
             is_joined = status == 'APPROVED'
             
@@ -970,7 +1791,7 @@ def list_teams():
                 "is_public": t.is_public,
                 "joined": is_joined, # Backward compat (only true if active member)
                 "membership_status": status, # PENDING, APPROVED, REJECTED
-                "member_count": TeamMember.query.filter_by(team_slug=t.slug).count(),
+                "member_count": m_count,
                 "invite_code": t.invite_code if is_joined else None
             })
         return jsonify(success=True, teams=result_teams, total_pages=1, current_page=1, quota={
@@ -978,44 +1799,43 @@ def list_teams():
             "joined": joined_count, "max_joined": 10
         })
 
-    # 2. Directory Tab (Public Teams - Paginated & Sorted)
-    query = db.session.query(Team, db.func.count(TeamMember.id).label('m_count'))\
-        .outerjoin(TeamMember, Team.slug == TeamMember.team_slug)\
-        .filter(Team.is_public == True)\
-        .group_by(Team.id)
-
-    if sort_by == 'created':
-        query = query.order_by(Team.created_at.desc())
-    elif sort_by == 'active':
-        query = query.order_by(Team.updated_at.desc())
-    elif sort_by == 'count':
-        query = query.order_by(db.desc('m_count'))
-    else: # alphabet
-        query = query.order_by(Team.name.asc())
-
-    pagination = query.paginate(page=page, per_page=limit, error_out=False)
+    # 2. Directory Tab (Public Teams - Sorted snapshot, keyset or page based)
+    directory = get_directory()
+    teams = directory.teams
+    slugs, position = directory.orders.get(sort_by) or directory.orders["alphabet"]
+    limit = max(1, min(limit, 100))
+    after = request.args.get('after')
+    if after:
+        # Keyset: continue after the last slug seen (restart if it has gone)
+        start = position[after] + 1 if after in position else 0
+    else:
+        start = (max(page, 1) - 1) * limit
+    page_slugs = slugs[start:start + limit]
     
     result_teams = []
-    for t, m_count in pagination.items:
-        status = my_teams_status.get(t.slug)
+    for slug in page_slugs:
+        t = teams[slug]
+        status = my_teams_status.get(slug)
         is_joined = status == 'APPROVED'
         
         result_teams.append({
-            "slug": t.slug, "name": t.name, 
-            "created_at": t.created_at.isoformat() if t.created_at else None,
+            "slug": slug, "name": t["name"], 
+            "created_at": t["created_at"].isoformat() if t["created_at"] else None,
             "is_public": True,
             "joined": is_joined,
             "membership_status": status,
-            "member_count": m_count,
-            "invite_code": t.invite_code if is_joined else None
+            "member_count": t["member_count"],
+            "invite_code": t["invite_code"] if is_joined else None
         })
 
+    total = len(slugs)
     return jsonify(
         success=True, 
         teams=result_teams, 
-        total_pages=pagination.pages, 
-        current_page=pagination.page,
-        total_count=pagination.total,
+        total_pages=-(-total // limit), 
+        current_page=start // limit + 1,
+        total_count=total,
+        next_after=page_slugs[-1] if start + limit < total else None,
         quota={
             "created": created_count, "max_created": 5,
             "joined": joined_count, "max_joined": 10
@@ -1047,6 +1867,9 @@ def approve_member():
     db.session.commit()
     return jsonify(success=True, status=mem.status)
 
+# Approximate JSON bytes per row of the disband backup beyond its text columns
+BACKUP_ROW_OVERHEAD = {"patient": 100, "event": 110, "member": 60}
+
 @app.route("/api/teams/stats", methods=["POST"])
 def team_stats():
     data = request.json
@@ -1055,26 +1878,26 @@ def team_stats():
     team = Team.query.filter_by(slug=slug).first()
     if not team: return jsonify(success=False, message="Team not found"), 404
     
-    patients = Patient.query.filter_by(team_id=slug).all()
-    members = TeamMember.query.filter_by(team_slug=slug).all()
-    
-    p_count = len(patients)
-    e_count = sum([len(p.events) for p in patients])
-    m_count = len(members)
-    
-    # Estimate Size (Roughly)
-    # Serialize once to check size? Or just estimate.
-    # Let's do a quick serialization to be accurate for backup
-    backup_data = {
-        "team": {"name": team.name, "slug": team.slug},
-        "patients": [],
-        "members": []
-    }
-    for p in patients:
-        backup_data["patients"].append({"name": p.name, "events": len(p.events)}) # Minimal for size check
-        
-    import json
-    size_bytes = len(json.dumps(backup_data))
+    # Counts and a size estimate straight from aggregates: text lengths summed
+    # in SQL plus a fixed JSON overhead per row (keys, ids, dates, punctuation)
+    def text_length(*cols):
+        return db.func.coalesce(db.func.sum(sum(db.func.length(db.func.coalesce(c, "")) for c in cols)), 0)
+
+    p_count, p_bytes = db.session.query(
+        db.func.count(Patient.id),
+        text_length(Patient.uid, Patient.name, Patient.sex, Patient.address, Patient.regime, Patient.remark)
+    ).filter(Patient.team_id == slug).one()
+    e_count, e_bytes = db.session.query(
+        db.func.count(Event.id),
+        text_length(Event.title, Event.color, Event.outcome)
+    ).join(Patient, Event.patient_id == Patient.id).filter(Patient.team_id == slug).one()
+    m_count, m_bytes = db.session.query(
+        db.func.count(TeamMember.id),
+        text_length(TeamMember.user_name, TeamMember.device_id, TeamMember.status)
+    ).filter(TeamMember.team_slug == slug).one()
+
+    size_bytes = int(p_bytes + e_bytes + m_bytes) + p_count * BACKUP_ROW_OVERHEAD["patient"] \
+        + e_count * BACKUP_ROW_OVERHEAD["event"] + m_count * BACKUP_ROW_OVERHEAD["member"]
     
     return jsonify(success=True, stats={
         "patients": p_count,
@@ -1108,10 +1931,88 @@ def leave_team():
                 
         db.session.delete(member)
         db.session.commit()
+        invalidate_directory(slug, member_delta=-1)
         return jsonify(success=True)
     except Exception as e:
         return jsonify(success=False, message=str(e)), 500
 
+# ---- TEAM ARCHIVE ----
+# A team backup is produced record by record from a server-side cursor, so
+# archiving (or disbanding) a large team never holds the whole team in memory.
+# Wire format is NDJSON: meta, team, member..., patient..., end.
+ARCHIVE_BATCH = 500 # Patients per cursor batch
+
+def team_backup_records(team, backup_type):
+    # Yields (type, record) pairs in wire order
+    yield "meta", {"exported_at": datetime.now().isoformat(), "backup_type": backup_type}
+    yield "team", {"name": team.name, "slug": team.slug, "created_at": team.created_at.isoformat() if team.created_at else None}
+    members = db.session.query(TeamMember.user_name, TeamMember.device_id, TeamMember.status)\
+        .filter(TeamMember.team_slug == team.slug)
+    for m in members.yield_per(ARCHIVE_BATCH):
+        yield "member", {"user_name": m.user_name, "device_id": m.device_id, "status": m.status}
+    patients = Patient.query.filter_by(team_id=team.slug).options(selectinload(Patient.events)).order_by(Patient.id)
+    for p in patients.yield_per(ARCHIVE_BATCH):
+        yield "patient", {
+            "uid": p.uid, "name": p.name, "age": p.age, "sex": p.sex,
+            "address": p.address, "regime": p.regime, "remark": p.remark,
+            "events": [{
+                "title": e.title, "start": wire_date(e.start), "original_start": wire_date(e.original_start),
+                "color": e.color, "missed_days": e.missed_days, "outcome": e.outcome
+            } for e in p.events]
+        }
+
+def stream_team_backup(team, backup_type, then=None):
+    # then(): runs after the last record has been sent; its dict is merged into
+    # the closing "end" line. If the client disconnects mid-stream the generator
+    # is closed at a yield and then() never runs.
+    def generate():
+        count = 0
+        for kind, record in team_backup_records(team, backup_type):
+            yield json.dumps({"type": kind, **record}) + "\n"
+            if kind == "patient": count += 1
+        end = {"type": "end", "patients": count}
+        if then: end.update(then())
+        yield json.dumps(end) + "\n"
+
+    filename = f"backup-{team.slug}-{datetime.now().strftime('%Y%m%d-%H%M%S')}.ndjson"
+    return Response(
+        stream_with_context(generate()), mimetype="application/x-ndjson",
+        headers={"Content-Disposition": f'attachment; filename="{filename}"'}
+    )
+
+def delete_team_data(slug):
+    # Set-based: a handful of statements whatever the team size. Tombstones are
+    # written first (INSERT ... SELECT) so peers drop the patients too. They are
+    # global (team_id NULL): once the team is gone no device is a member of it,
+    # so team-scoped tombstones would never be served to anyone.
+    rev = next_sync_rev(db.session)
+    now = datetime.utcnow()
+    patient_t, event_t = Patient.__table__, Event.__table__
+    team_patients = db.select(patient_t.c.id).where(patient_t.c.team_id == slug)
+    db.session.execute(DeletedRecord.__table__.insert().from_select(
+        ["uid", "team_id", "sync_rev", "timestamp"],
+        db.select(patient_t.c.uid, db.null(), db.literal(rev), db.literal(now))
+        .where(patient_t.c.team_id == slug, patient_t.c.uid.isnot(None))
+    ))
+    db.session.execute(event_t.delete().where(event_t.c.patient_id.in_(team_patients)))
+    db.session.execute(patient_t.delete().where(patient_t.c.team_id == slug))
+    db.session.execute(TeamMember.__table__.delete().where(TeamMember.__table__.c.team_slug == slug))
+    bump_members_rev(db.session)
+    db.session.execute(Team.__table__.delete().where(Team.__table__.c.slug == slug))
+    # Team Tombstone for Sync: prefixed with 'team:' so merge logic knows it's a team
+    db.session.execute(DeletedRecord.__table__.insert().values(uid=f"team:{slug}", team_id=None, sync_rev=rev, timestamp=now))
+
+def is_team_admin(device_id, slug):
+    return any(s == slug and role == 'ADMIN' for s, _, role in get_device_memberships(device_id))
+
+@app.route("/api/teams/<slug>/archive", methods=["GET"])
+def archive_team(slug):
+    if not is_team_admin(request.headers.get('X-Device-ID'), slug):
+        return jsonify(success=False, message="Unauthorized: Only Team Admins can export."), 403
+    team = Team.query.filter_by(slug=slug).first()
+    if not team: return jsonify(success=False, message="Team not found"), 404
+    return stream_team_backup(team, "team_archive")
+
 @app.route("/api/teams/disband", methods=["POST"])
 def disband_team():
     try:
@@ -1129,50 +2030,32 @@ def disband_team():
 
         team = Team.query.filter_by(slug=slug).first()
         if not team: return jsonify(success=False, message="Team not found"), 404
-        
-        # 1. Generate Backup
-        patients = Patient.query.filter_by(team_id=slug).all()
-        members = TeamMember.query.filter_by(team_slug=slug).all()
-        
-        backup = {
-            "meta": {"exported_at": datetime.now().isoformat(), "type": "team_disband_backup"},
-            "team": {"name": team.name, "slug": team.slug, "created_at": team.created_at.isoformat()},
-            "members": [{"user_name": m.user_name, "device_id": m.device_id, "status": m.status} for m in members],
-            "patients": []
-        }
-        
-        for p in patients:
-            p_data = {
-                "uid": p.uid, "name": p.name, "age": p.age, "sex": p.sex,
-                "address": p.address, "regime": p.regime, "remark": p.remark,
-                "events": []
-            }
-            for e in p.events:
-                p_data["events"].append({
-                    "title": e.title, "start": e.start, "original_start": e.original_start,
-                    "color": e.color, "missed_days": e.missed_days, "outcome": e.outcome
-                })
-            backup["patients"].append(p_data)
-            
-        # 2. Delete Data
-        for p in patients:
-            # Delete events
-            Event.query.filter_by(patient_id=p.id).delete()
-            # Delete patient
-            db.session.delete(p)
-            # Create Tombstone for patient? Yes, to be safe.
-            if p.uid: db.session.add(DeletedRecord(uid=p.uid))
-            
-        for m in members:
-            db.session.delete(m)
-            
-        db.session.delete(team)
-        
-        # 3. Create Team Tombstone for Sync
-        # Prefix with 'team:' so merge logic knows it's a team
-        db.session.add(DeletedRecord(uid=f"team:{slug}"))
-        
-        db.session.commit()
+
+        def disband():
+            delete_team_data(slug)
+            db.session.commit()
+            invalidate_directory()
+
+        # 1. Streaming (?stream=1 or {"stream": true}): the backup streams out
+        # first and the team is deleted only once the last record has been
+        # sent; the final line reports {"disbanded": true}
+        if data.get("stream") or request.args.get("stream"):
+            def then():
+                try:
+                    disband()
+                    return {"disbanded": True}
+                except Exception as e:
+                    db.session.rollback()
+                    return {"disbanded": False, "message": str(e)}
+            return stream_team_backup(team, "team_disband_backup", then=then)
+
+        # 2. Inline JSON backup (older clients)
+        backup = {"meta": None, "team": None, "members": [], "patients": []}
+        for kind, record in team_backup_records(team, "team_disband_backup"):
+            if kind == "meta": backup["meta"] = {"exported_at": record["exported_at"], "type": record["backup_type"]}
+            elif kind == "team": backup["team"] = record
+            else: backup[kind + "s"].append(record)
+        disband()
         
         return jsonify(success=True, backup=backup)
         
@@ -1218,6 +2101,105 @@ def secure_migrate():
         conn.commit()
         conn.close()
 
+# ---- VERSIONED SCHEMA MIGRATIONS ----
+# Append-only: (version, [steps]). Each version runs once and is recorded in
+# schema_version. A step is plain SQL valid on both SQLite and Postgres, or a
+# callable taking the connection; all are idempotent, so a half-applied version
+# can simply be re-run.
+def add_column(table, column, ddl):
+    # SQLite has no ADD COLUMN IF NOT EXISTS, so check the live schema first
+    def step(conn):
+        if column not in {c["name"] for c in sa_inspect(conn).get_columns(table)}:
+            conn.execute(db.text(f"ALTER TABLE {table} ADD COLUMN {column} {ddl}"))
+    return step
+
+def retype_as_date(table, column):
+    def step(conn):
+        if conn.dialect.name == "sqlite":
+            # SQLite stores DATE as ISO text already; just normalise the values
+            # (anything that is not a parseable date becomes NULL)
+            conn.execute(db.text(f"UPDATE {table} SET {column} = date({column}) WHERE {column} IS NOT NULL"))
+        else:
+            # Fresh databases get DATE from create_all(); only retype legacy text
+            col = next(c for c in sa_inspect(conn).get_columns(table) if c["name"] == column)
+            if isinstance(col["type"], db.Date): return
+            conn.execute(db.text(
+                f"ALTER TABLE {table} ALTER COLUMN {column} TYPE DATE USING NULLIF({column}::text, '')::date"
+            ))
+    return step
+
+def backfill_content_hashes(conn):
+    missing = [row[0] for row in conn.execute(db.text("SELECT id FROM patient WHERE content_hash IS NULL"))]
+    refresh_content_hashes(conn, missing)
+
+def rehash_all_patients(conn):
+    refresh_content_hashes(conn, [row[0] for row in conn.execute(db.text("SELECT id FROM patient"))])
+
+SCHEMA_MIGRATIONS = [
+    (1, [
+        # Hot filter columns (events, sync, ripple, auth, tombstones)
+        "CREATE INDEX IF NOT EXISTS ix_event_start ON event (start)",
+        "CREATE INDEX IF NOT EXISTS ix_patient_team_updated ON patient (team_id, updated_at)",
+        "CREATE INDEX IF NOT EXISTS ix_event_patient_original_start ON event (patient_id, original_start)",
+        "CREATE INDEX IF NOT EXISTS ix_event_updated_at ON event (updated_at)",
+        "CREATE INDEX IF NOT EXISTS ix_team_member_device_status ON team_member (device_id, status)",
+        "CREATE INDEX IF NOT EXISTS ix_team_member_team_status ON team_member (team_slug, status)",
+        "CREATE INDEX IF NOT EXISTS ix_deleted_record_uid ON deleted_record (uid)",
+        "CREATE INDEX IF NOT EXISTS ix_deleted_record_timestamp ON deleted_record (timestamp)",
+    ]),
+    (2, [
+        # Change cursor for delta sync (existing rows start at revision 0)
+        add_column("patient", "sync_rev", "INTEGER DEFAULT 0"),
+        add_column("team", "sync_rev", "INTEGER DEFAULT 0"),
+        add_column("team_member", "sync_rev", "INTEGER DEFAULT 0"),
+        add_column("deleted_record", "sync_rev", "INTEGER DEFAULT 0"),
+        "CREATE INDEX IF NOT EXISTS ix_patient_team_rev ON patient (team_id, sync_rev)",
+        "CREATE INDEX IF NOT EXISTS ix_deleted_record_sync_rev ON deleted_record (sync_rev)",
+    ]),
+    (3, [
+        # Team-scoped, compactable tombstones
+        add_column("deleted_record", "team_id", "VARCHAR(50)"),
+        add_column("team_member", "synced_rev", "INTEGER DEFAULT 0"),
+        add_column("sync_counter", "compacted_rev", "INTEGER DEFAULT 0"),
+        "CREATE INDEX IF NOT EXISTS ix_deleted_record_team_rev ON deleted_record (team_id, sync_rev)",
+    ]),
+    (4, [
+        # Event.start / original_start become native DATE columns
+        retype_as_date("event", "start"),
+        retype_as_date("event", "original_start"),
+    ]),
+    (5, [
+        # Content digest on every patient
+        add_column("patient", "content_hash", "VARCHAR(40)"),
+        backfill_content_hashes,
+    ]),
+    (6, [
+        # team_id joined the digest: re-digest every patient
+        rehash_all_patients,
+    ]),
+    (7, [
+        # Shared membership revision for the per-worker authorization cache
+        add_column("sync_counter", "members_rev", "INTEGER DEFAULT 0"),
+    ]),
+]
+
+def run_schema_migrations():
+    # Runs after db.create_all(), so every table referenced above exists
+    with db.engine.begin() as conn:
+        conn.execute(db.text("CREATE TABLE IF NOT EXISTS schema_version (version INTEGER PRIMARY KEY, applied_at TIMESTAMP)"))
+        applied = {row[0] for row in conn.execute(db.text("SELECT version FROM schema_version"))}
+
+        for version, steps in SCHEMA_MIGRATIONS:
+            if version in applied: continue
+            print(f"Migrating: Applying schema version {version}...")
+            for step in steps:
+                if callable(step): step(conn)
+                else: conn.execute(db.text(step))
+            conn.execute(
+                db.text("INSERT INTO schema_version (version, applied_at) VALUES (:v, :t)"),
+                {"v": version, "t": datetime.utcnow()}
+            )
+
 @app.after_request
 def after_request(response):
     response.headers.add('Access-Control-Allow-Origin', '*')
@@ -1225,8 +2207,27 @@ def after_request(response):
     response.headers.add('Access-Control-Allow-Methods', 'GET,PUT,POST,DELETE,OPTIONS')
     return response
 
-if __name__ == "__main__":
+def prepare_database():
     with app.app_context():
         secure_migrate()
         db.create_all()
+        run_schema_migrations()
+
+def create_app():
+    # WSGI entry point for production servers, e.g. (see Procfile)
+    #   gunicorn --preload "app:create_app()" --workers 1 --threads 8
+    # One worker: the membership/regime/colour/directory caches are per process
+    # and are only invalidated in the worker that handled the change.
+    # With --preload this runs once in the master, so migrations never race
+    # between workers. The pool is disposed so forked workers open their own
+    # connections; the host address refresher starts lazily in each worker.
+    prepare_database()
+    with app.app_context():
+        db.engine.dispose()
+    return app
+
+if __name__ == "__main__":
+    # Development server (single process); use create_app() in production
+    prepare_database()
+    start_host_ip_refresher()
     app.run(host="0.0.0.0", port=int(os.environ.get("PORT", 5000)))
@@ -89,6 +89,13 @@ def migrate():
 
     conn.commit()
     conn.close()
+
+    # 5. Versioned schema migrations (indexes), shared with app startup
+    from app import app, db, run_schema_migrations
+    with app.app_context():
+        db.create_all()
+        run_schema_migrations()
+
     print("Migration Complete.")
 
 if __name__ == "__main__":
@@ -686,6 +686,7 @@ document.addEventListener('DOMContentLoaded', function() {
 
   // Global Sync State
   window.lastSyncTime = localStorage.getItem('tb_last_sync_time') || null;
+  window.lastSyncCursor = localStorage.getItem('tb_sync_cursor') || null;
 
   window.setSyncState = function(state, text = null, title = null) {
       const btn = document.getElementById('syncBtn');
@@ -712,12 +713,25 @@ document.addEventListener('DOMContentLoaded', function() {
 
       let url = team ? `/api/get_all_data?team=${team}` : '/api/get_all_data';
       
-      // Delta Sync: Only request 'since' if we have data and a previous sync time
-      if(window.lastSyncTime && window.allPatientData && window.allPatientData.length > 0) {
-          url += (url.includes('?') ? '&' : '?') + `since=${window.lastSyncTime}`;
+      // Delta Sync: Only request changes if we have data and a previous sync point.
+      // Prefer the server's change cursor; without one, send the digests of what
+      // we hold so only differing records come back; 'since' is kept for older hosts.
+      let digestBody = null;
+      if(window.allPatientData && window.allPatientData.length > 0) {
+          if(window.lastSyncCursor) {
+              url += (url.includes('?') ? '&' : '?') + `cursor=${window.lastSyncCursor}`;
+          } else if(window.allPatientData.every(p => p.digest)) {
+              digestBody = JSON.stringify({ digests: Object.fromEntries(window.allPatientData.map(p => [p.uid, p.digest])) });
+          } else if(window.lastSyncTime) {
+              url += (url.includes('?') ? '&' : '?') + `since=${window.lastSyncTime}`;
+          }
       }
       
-      fetch(url, {
+      fetch(url, digestBody ? {
+          method: 'POST',
+          headers: { 'X-Device-ID': deviceId, 'Content-Type': 'application/json' },
+          body: digestBody
+      } : {
           headers: { 'X-Device-ID': deviceId }
       })
       .then(res => {
@@ -734,11 +748,16 @@ document.addEventListener('DOMContentLoaded', function() {
                   window.lastSyncTime = data.timestamp;
                   localStorage.setItem('tb_last_sync_time', data.timestamp);
               }
+              if(data.cursor !== undefined && data.cursor !== null) {
+                  window.lastSyncCursor = String(data.cursor);
+                  localStorage.setItem('tb_sync_cursor', window.lastSyncCursor);
+              }
 
               // Process Notifications
               if(window.processSyncNotifications) window.processSyncNotifications(data);
               
-              const isDelta = url.includes('since=');
+              // 'reset': the host compacted tombstones past our cursor and sent a full set
+              const isDelta = (url.includes('since=') || url.includes('cursor=') || digestBody !== null) && !data.reset;
 
               if(isDelta) {
                   console.log(`[Cloud Sync] Received delta: ${data.data.length} updates, ${data.deleted.length} deletions`);
@@ -944,10 +963,8 @@ document.addEventListener('DOMContentLoaded', function() {
                 const ids = ['headerCount', 'totalCount', 'activeCount'];
                 ids.forEach(id => {
                     const el = document.getElementById(id);
-                    if (el) {
-                        let val = parseInt(el.innerText || '0');
-                        el.innerText = Math.max(0, val - 1);
-                    }
+                    let val = el ? parseInt(el.innerText) : NaN;
+                    if (!isNaN(val)) el.innerText = Math.max(0, val - 1);
                 });
 
                 calendar.refetchEvents();
@@ -1826,6 +1843,39 @@ document.addEventListener('DOMContentLoaded', () => {
         });
     }
 
+    // Registry Infinite Scroll (the server renders only the first page)
+    const registryMore = document.getElementById('registryMore');
+    if(registryMore && 'IntersectionObserver' in window) {
+        let loadingMore = false;
+        const observer = new IntersectionObserver(entries => {
+            if(!entries.some(e => e.isIntersecting)) return;
+            const after = registryMore.dataset.nextAfter;
+            if(!after || loadingMore) return;
+            loadingMore = true;
+
+            const deviceId = localStorage.getItem('tb_device_name') || 'Guest';
+            fetch(`/api/patients?after=${after}`, {
+                headers: { 'X-Device-ID': deviceId }
+            })
+            .then(res => res.json())
+            .then(data => {
+                if(!data.success) return;
+                const list = document.getElementById('registryList');
+                data.patients.forEach(p => list.insertAdjacentHTML('beforeend', renderRegistryItem(p)));
+                registryMore.dataset.nextAfter = data.next_after || '';
+                updateRegistryStatus();
+            })
+            .catch(err => console.warn("Registry page load failed:", err))
+            .finally(() => {
+                loadingMore = false;
+                // Re-observe so a sentinel that is still visible loads the next page
+                observer.unobserve(registryMore);
+                observer.observe(registryMore);
+            });
+        });
+        observer.observe(registryMore);
+    }
+
     // Initial Patient Status/Progress Update
     updateRegistryStatus();
     
@@ -1840,6 +1890,39 @@ document.addEventListener('DOMContentLoaded', () => {
     // Initial Dashboard Update
     window.updateDashboardCounts();
 });
+// Same markup as the server-rendered registry items in index.html
+function renderRegistryItem(p) {
+    const esc = (v) => String(v ?? '').replace(/[&<>"']/g, c => ({'&':'&amp;','<':'&lt;','>':'&gt;','"':'&quot;',"'":'&#39;'}[c]));
+    const out = p.last_outcome;
+    const good = out === 'Cured' || out === 'Completed';
+    const badge = !out
+        ? '<span class="badge badge-active">Active</span>'
+        : `<span class="badge" style="background: ${good ? '#dcfce7' : '#fee2e2'}; color: ${good ? '#166534' : '#991b1b'};">${esc(out)}</span>`;
+
+    return `
+    <li class="patient-item" data-name="${esc(p.name.toLowerCase())}" data-uid="${esc(p.uid)}"
+        data-start="${esc(p.start)}" data-regime="${esc(p.regime)}" style="border-left-color: ${esc(p.color || '#cbd5e1')}; display: none;">
+      <div style="display: flex; justify-content: space-between; align-items: flex-start;">
+        <div style="flex: 1">
+          <strong onclick="openPatientDetail('${esc(p.uid)}')" class="patient-name-link">
+            ${esc(p.name)} <span class="info-icon">ⓘ</span>
+          </strong>
+          <div class="patient-meta">Age: ${esc(p.age)} • ${esc(p.sex)} • ${esc(p.regime)}</div>
+        </div>
+        <div class="patient-status" id="status-${esc(p.uid)}">${badge}</div>
+      </div>
+      <div class="progress-container" style="margin-top: 10px">
+        <div class="progress-bar-bg">
+          <div class="progress-bar-fill" id="progress-${esc(p.uid)}" style="width: 0%"></div>
+        </div>
+        <div class="progress-label" id="progress-text-${esc(p.uid)}">Calculating...</div>
+      </div>
+      <div style="margin-top: 10px; display: flex; justify-content: flex-end;">
+        <button class="deletePatientBtn btn-text-danger" data-id="${esc(p.id)}">✕ Remove</button>
+      </div>
+    </li>`;
+}
+
 window.updateRegistryStatus = async function(viewStart, viewEnd) {
     // SECURITY: Hide all registry items immediately
     document.querySelectorAll('.patient-item').forEach(li => {
@@ -2750,22 +2833,31 @@ window.executeDisband = function(slug) {
             'Content-Type': 'application/json', 
             'X-Device-ID': deviceId
         },
-        body: JSON.stringify({ slug: slug, device_id: deviceId })
+        // Streamed NDJSON backup; the server deletes the team only after the
+        // last record is sent and reports it on the final "end" line
+        body: JSON.stringify({ slug: slug, device_id: deviceId, stream: true })
     })
     .then(res => {
-        if(!res.ok) throw new Error("Disband request failed");
-        return res.json();
+        if(!res.ok) {
+            return res.json().catch(() => ({})).then(body => { throw new Error(body.message || "Disband request failed"); });
+        }
+        return res.text();
     })
-    .then(res => {
+    .then(text => {
+        const lines = text.trim().split('\n');
+        let end = {};
+        try { end = JSON.parse(lines[lines.length - 1]); } catch(e) {}
+        const res = { success: end.type === 'end' && end.disbanded === true, message: end.message || "Backup incomplete, team was not disbanded" };
         if(res.success) {
             // Trigger Download
-            const dataStr = "data:text/json;charset=utf-8," + encodeURIComponent(JSON.stringify(res.backup, null, 2));
+            const url = URL.createObjectURL(new Blob([text], { type: 'application/x-ndjson' }));
             const downloadAnchorNode = document.createElement('a');
-            downloadAnchorNode.setAttribute("href", dataStr);
-            downloadAnchorNode.setAttribute("download", `backup-${slug}-${new Date().toISOString()}.json`);
+            downloadAnchorNode.setAttribute("href", url);
+            downloadAnchorNode.setAttribute("download", `backup-${slug}-${new Date().toISOString()}.ndjson`);
             document.body.appendChild(downloadAnchorNode); // required for firefox
             downloadAnchorNode.click();
             downloadAnchorNode.remove();
+            setTimeout(() => URL.revokeObjectURL(url), 1000);
             
             showToast("Team Disbanded & Backup Downloaded.");
             